@@ -14,6 +14,7 @@ import psutil  # for memory check
 from PyQt6.QtWidgets import QApplication, QFileDialog
 from typing import List
 from pathlib import Path
+from ScanDataPy.model.file_io import FileProbe
 # import itertools
 
 # from conda.base.context import mockable_context_envs_dirs
@@ -104,6 +105,31 @@ class FileService:
             print(f"Error getting file list: {str(e)}")
             return []
 
+    @staticmethod
+    def get_file_infor_list(file_path: str, extension: str = None) -> List[dict]:
+        """
+        Get header records of files with the same extension in the same folder.
+        Only headers are read, so it is fast even for hundreds of recordings.
+
+        Args:
+            file_path (str): Path to the reference file
+            extension (str, optional): Specific extension to filter files
+
+        Returns:
+            List[dict]: List of records. See FileProbe class in file_io.py
+        """
+        dir_path = os.path.dirname(os.path.normpath(file_path))
+        file_infor_list = []
+        for filename in sorted(
+            FileService.get_files_with_same_extension(file_path, extension)
+        ):
+            filename_obj = WholeFilename(os.path.join(dir_path, filename))
+            try:
+                file_infor_list.append(FileProbe.probe(filename_obj))
+            except Exception as e:
+                print(f"Error reading file infor of {filename}: {str(e)}")
+        return file_infor_list
+
     def get_filename_obj(self):
         return self.filename_obj_list
 
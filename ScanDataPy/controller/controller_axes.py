@@ -30,6 +30,14 @@ class AxesController(metaclass=ABCMeta):
         self.update_flag = False  # Ture or False or empty: flip flag.
         self.update_flag_lock = False  # to skip ImageAxe update
 
+        # dependency of the shown items.
+        # {(tag_dict items, item modifier_list): [tag_dict, plot_data, modifier name set]}
+        self._view_item_dict = {}
+        # modifiers notified after the last update. None means all items.
+        self._changed_modifier_set = None
+        # modifiers used while an item is made. see get_item_data()
+        self._dependency_set = None
+
         # color selection for traces and ROiooxes
         setting = None
         search_paths = [
@@ -103,12 +111,87 @@ class AxesController(metaclass=ABCMeta):
         return self._canvas, self._ax_obj
 
     # update flag from the UserController classes in the model
-    def set_update_flag(self, update_flag):
+    # modifier_name is from the modifier observer. Without it, all items are updated.
+    def set_update_flag(self, update_flag, modifier_name=None):
         if self.update_flag_lock == True:
             pass
         else:
+            if update_flag is True and modifier_name is not None:
+                if self.update_flag is not True:
+                    self._changed_modifier_set = set()
+                if self._changed_modifier_set is not None:
+                    self._changed_modifier_set.add(modifier_name)
+            else:
+                self._changed_modifier_set = None
             self.update_flag = update_flag
 
+    # [(key, tag_dict, item modifier_list), ...] of items to show.
+    # If the modifier_list has a Roi, there is an item for each Roi in roi_list.
+    def get_request_list(self):
+        modifier_list = self._key_manager.get_list('modifier_list')
+        roi_list = self._key_manager.get_list('roi_list')
+        no_roi_list = [
+            name for name in modifier_list
+            if Tools.remove_tail_numbers(name) != 'Roi'
+        ]
+        if roi_list and len(no_roi_list) < len(modifier_list):
+            item_modifier_list_list = [no_roi_list + [roi] for roi in roi_list]
+        else:
+            item_modifier_list_list = [list(modifier_list)]
+        return [
+            ((tuple(tag_dict.items()), tuple(item_modifier_list)), tag_dict,
+             item_modifier_list)
+            for tag_dict in self._key_manager.get_dicts_from_tag_list()
+            for item_modifier_list in item_modifier_list_list
+        ]
+
+    # get data and the modifier names used for it. Modifiers of the second data
+    # (e.g. the baseline of BlComp) are added by make_second_obj().
+    def get_item_data(self, tag_dict, modifier_list):
+        self._dependency_set = set(modifier_list)
+        try:
+            value_obj = self._model.get_data(tag_dict, modifier_list)
+        finally:
+            dependency_set, self._dependency_set = self._dependency_set, None
+        return value_obj, dependency_set
+
+    # get_item_data of many items. item_list = [(tag_dict, modifier_list), ...]
+    # Items without the second data are made at once in threads by the model.
+    # The others use this controller (make_second_obj) and are made one by one
+    # to know the modifiers of each item.
+    def get_items_data(self, item_list) -> list:
+        item_data_list = [None] * len(item_list)
+        parallel_index_list = [
+            i for i, (_, modifier_list) in enumerate(item_list)
+            if self._model.is_thread_safe(modifier_list)
+        ]
+        value_obj_list = self._model.get_data_many(
+            [item_list[i] for i in parallel_index_list]
+        )
+        for i, value_obj in zip(parallel_index_list, value_obj_list):
+            item_data_list[i] = (value_obj, set(item_list[i][1]))
+        for i, (tag_dict, modifier_list) in enumerate(item_list):
+            if item_data_list[i] is None:
+                item_data_list[i] = self.get_item_data(tag_dict, modifier_list)
+        return item_data_list
+
+    def record_dependency(self, modifier_list):
+        if self._dependency_set is not None:
+            self._dependency_set.update(modifier_list)
+
+    # keys of items made with the changed modifiers. None if all items should be
+    # updated. (the first update, tags were changed or the update without modifier)
+    def get_affected_keys(self, request_list):
+        if self._changed_modifier_set is None or [
+            key for key, _, _ in request_list
+        ] != list(self._view_item_dict):
+            return None
+        return [
+            key
+            for key, (_, _, dependency_set) in self._view_item_dict.items()
+            if dependency_set & self._changed_modifier_set
+        ]
+
     def set_data(self, data_tag, modifier_list=None):
         self._model.set_data(self, data_tag, modifier_list)
 
@@ -167,24 +250,33 @@ class ImageAxesController(AxesController):
 
     # from the flag, get data from the model and show data.
     def get_view_data(self):
-        # get lists of the data tag list
-        lists_of_tag_dict = self._key_manager.get_dicts_from_tag_list()
-        # get modifier list
-        modifier_list = self._key_manager.get_list('modifier_list')
-
-        for tag_dict in lists_of_tag_dict:
-            value_obj = self._model.get_data(tag_dict, modifier_list)
+        # get lists of the data tag list and modifier list
+        request_list = self.get_request_list()
+        self._view_item_dict = {}
+        item_data_list = self.get_items_data(
+            [(tag_dict, modifier_list) for _, tag_dict, modifier_list in request_list]
+        )
+
+        for (key, tag_dict, _), (value_obj, dependency_set) in zip(
+            request_list, item_data_list
+        ):
             # show data
             plot_data = value_obj.show_data(self._ax_obj)
             # combine keys  e.g. '20408B002.tsmDataFluoImageCh1Average0'
             item_key = ''.join(value_obj.data_tag.values())
             # make a new item dict for a graph
             self.ax_item_dict[item_key] = plot_data
+            self._view_item_dict[key] = [tag_dict, plot_data, dependency_set]
             self._ax_obj.setPredefinedGradient(self.color_mode)
 
     # override    should be in main controller
     def update(self) -> None:
         if self.update_flag is True:
+            # The image is one item. Skip it if the changed modifiers are not used.
+            request_list = self.get_request_list()
+            if self.get_affected_keys(request_list) == []:
+                print(f"AxesController: {self.__class__.__name__} is not affected")
+                return
             # delete old image objects. not delete box
             self._ax_obj.clear()
             self.ax_item_dict = {}
@@ -231,7 +323,11 @@ class ImageAxesController(AxesController):
             'TimeWindow1',
             'Average0'
         ]
-        # return to modifier BlComp class
+        # the item being made depends on these modifiers too
+        self.record_dependency(baseline_modifier_tag_list)
+        # The same baseline image is reused by ResultCache of the model until the
+        # source frames or the modifiers are changed.
+        # return to modifier DifImage class
         return self._model.get_data(baseline_data_tag, baseline_modifier_tag_list)
 
 
@@ -243,10 +339,16 @@ class TraceAxesController(AxesController):
 
     def update(self):
         if self.update_flag is True:
-            # clear axes variables
-            self._ax_obj.clear()
-            # See each subclass.
-            self.get_view_data()
+            request_list = self.get_request_list()
+            affected_key_list = self.get_affected_keys(request_list)
+            if affected_key_list is None:
+                # clear axes variables
+                self._ax_obj.clear()
+                # See each subclass.
+                self.get_view_data()
+            else:
+                # only items made with the changed modifiers
+                self.update_items(affected_key_list)
             # axes method
             self._ax_obj.autoRange()
             print(f"AxesController: {self.__class__.__name__} updated")
@@ -258,43 +360,59 @@ class TraceAxesController(AxesController):
 
     # from the flag, get data from the model and show data. 
     def get_view_data(self):
-        # get lists of the data tag list
-        lists_of_tag_dict = self._key_manager.get_dicts_from_tag_list()
-        # get modifier list
-        modifier_list = self._key_manager.get_list('modifier_list')
-        for tag_dict in lists_of_tag_dict:
-            value_obj = self._model.get_data(tag_dict, modifier_list)
-
-            # show data
-            plot_data = value_obj.show_data(self._ax_obj)
-            # combine keys  e.g. '20408B002.tsmDataFluoTraceCh1Average0'
-            item_key = ''.join(value_obj.data_tag.values())
-            # make a new item dict for a graph
-            self.ax_item_dict[item_key] = plot_data
-
-            # color setting
-            if self.mode == "ChMode":
-                if 'Elec' in value_obj.data_tag['DataType']:
-                    plot_data.setPen(
-                        pg.mkPen(color=self._ch_colors[value_obj.data_tag['DataType']]))
-                elif 'Fluo' in value_obj.data_tag['DataType']:
-                    plot_data.setPen(
-                        pg.mkPen(color=self._ch_colors[value_obj.data_tag['DataType']]))
-                else:
-                    plot_data.setPen(
-                        pg.mkPen(color=self._ch_colors["black"]))
-            elif self.mode == "RoiMode":
-                if 'Elec' in value_obj.data_tag['DataType']:
-                    plot_data.setPen(
-                        pg.mkPen(color=self._ch_colors[value_obj.data_tag['DataType']]))
-                    print(tag_dict.values())
-                elif 'Fluo' in value_obj.data_tag['Origin']:
-                    plot_data.setPen(
-                        pg.mkPen(color=self._ch_colors[
-                            value_obj.data_tag['Origin']]))
-                else:
-                    plot_data.setPen(
-                        pg.mkPen(color=self._ch_colors["black"]))
+        # get lists of the data tag list and modifier list
+        request_list = self.get_request_list()
+        self._view_item_dict = {}
+        for key, tag_dict, _ in request_list:
+            self._view_item_dict[key] = [tag_dict, None, None]
+        self.update_items(list(self._view_item_dict))
+
+    # get data of items at once and replace the plots of them.
+    # The modifier list of an item is in the key.
+    def update_items(self, key_list):
+        item_data_list = self.get_items_data(
+            [(self._view_item_dict[key][0], list(key[1])) for key in key_list]
+        )
+        for key, (value_obj, dependency_set) in zip(key_list, item_data_list):
+            self.update_item(key, value_obj, dependency_set)
+
+    # replace the plot of an item.
+    def update_item(self, key, value_obj, dependency_set):
+        tag_dict, old_plot_data, _ = self._view_item_dict[key]
+        if old_plot_data is not None:
+            self._ax_obj.removeItem(old_plot_data)
+
+        # show data
+        plot_data = value_obj.show_data(self._ax_obj)
+        # combine keys  e.g. '20408B002.tsmDataFluoTraceCh1Average0'
+        item_key = ''.join(value_obj.data_tag.values())
+        # make a new item dict for a graph
+        self.ax_item_dict[item_key] = plot_data
+        self._view_item_dict[key] = [tag_dict, plot_data, dependency_set]
+
+        # color setting
+        if self.mode == "ChMode":
+            if 'Elec' in value_obj.data_tag['DataType']:
+                plot_data.setPen(
+                    pg.mkPen(color=self._ch_colors[value_obj.data_tag['DataType']]))
+            elif 'Fluo' in value_obj.data_tag['DataType']:
+                plot_data.setPen(
+                    pg.mkPen(color=self._ch_colors[value_obj.data_tag['DataType']]))
+            else:
+                plot_data.setPen(
+                    pg.mkPen(color=self._ch_colors["black"]))
+        elif self.mode == "RoiMode":
+            if 'Elec' in value_obj.data_tag['DataType']:
+                plot_data.setPen(
+                    pg.mkPen(color=self._ch_colors[value_obj.data_tag['DataType']]))
+                print(tag_dict.values())
+            elif 'Fluo' in value_obj.data_tag['Origin']:
+                plot_data.setPen(
+                    pg.mkPen(color=self._ch_colors[
+                        value_obj.data_tag['Origin']]))
+            else:
+                plot_data.setPen(
+                    pg.mkPen(color=self._ch_colors["black"]))
 
     def onclick_axes(self, val):
         if self.current_mode == 'Normal':
@@ -334,6 +452,8 @@ class TraceAxesController(AxesController):
             'Average1',
             'TagMaker0'
         ]
+        # the item being made depends on these modifiers too
+        self.record_dependency(baseline_modifier_tag_list)
         # return to modifier BlComp class
         return self._model.get_data(baseline_data_tag, baseline_modifier_tag_list)
 
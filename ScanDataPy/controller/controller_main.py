@@ -122,8 +122,27 @@ class MainController:
         print("--------------------------------")
         print("")
 
+        # load the previous and the next files in the background
+        self.__model.prefetch(
+            self.__get_neighbor_files(filename_obj, same_ext_file_list)
+        )
+
         return filename_obj, same_ext_file_list
 
+    # fullnames of the next and the previous files in the sorted file list
+    @staticmethod
+    def __get_neighbor_files(filename_obj, same_ext_file_list) -> list:
+        sorted_list = sorted(same_ext_file_list)
+        if filename_obj.name not in sorted_list:
+            return []
+        idx = sorted_list.index(filename_obj.name)
+        neighbor_idx_list = [idx + 1, idx - 1]  # the next file first
+        return [
+            filename_obj.path + sorted_list[i]
+            for i in neighbor_idx_list
+            if 0 <= i < len(sorted_list)
+        ]
+
     def create_experiments(self, filename_obj: object):
         print("MainController: create_experiments() ----->")
         new_data = self.__model.create_experiments(filename_obj.fullname)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Curve fitting for baseline compensation (BlComp).
+Fitted parameters are cached with a hash of the fitted trace, so the same
+baseline is not fitted again at every redraw.
+
+@author: lunelukkio@gmail.com
+"""
+
+import hashlib
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+from scipy.optimize import curve_fit
+from ScanDataPy.common_class import Tools
+
+
+class Fitter(metaclass=ABCMeta):
+    # return parameters of the fitting
+    @abstractmethod
+    def fit(self, time: np.ndarray, data: np.ndarray) -> tuple:
+        raise NotImplementedError()
+
+    # return a fitting curve at time from the parameters
+    @abstractmethod
+    def evaluate(self, params: tuple, time: np.ndarray) -> np.ndarray:
+        raise NotImplementedError()
+
+
+class PolyFitter(Fitter):
+    def __init__(self, degree=2):
+        self.degree = degree
+
+    # params = (time mean, time std, polynomial coefficients)
+    def fit(self, time, data) -> tuple:
+        mu = (np.mean(time), np.std(time))
+        # time data centering and scaling
+        t_scaled = (time - mu[0]) / mu[1]
+        fitcoef = np.polyfit(t_scaled, data, self.degree)
+        return (mu[0], mu[1], fitcoef)
+
+    def evaluate(self, params, time) -> np.ndarray:
+        mean, std, fitcoef = params
+        return np.polyval(fitcoef, (time - mean) / std)
+
+
+class ExpFitter(Fitter):
+    # a * exp(b * t) + c by scipy curve_fit (iterative)
+    def fit(self, time, data) -> tuple:
+        initial_guess = (np.max(data), -0.1, np.min(data))
+        popt, pcov = curve_fit(
+            Tools.exponential_func, time, data, p0=initial_guess, maxfev=2000
+        )
+        return tuple(popt)
+
+    def evaluate(self, params, time) -> np.ndarray:
+        return Tools.exponential_func(time, *params)
+
+
+class IntegralExpFitter(Fitter):
+    # a * exp(b * (t - t0)) + c without iteration (integral equation method).
+    # y - y0 = b * integral(y - c) = b * S(t) - b * c * (t - t0), so b is from
+    # a linear regression of y - y0 on S and t - t0. Then a and c are from a linear
+    # regression of y on exp(b * (t - t0)).
+    # params = (a, b, c, t0)
+    def fit(self, time, data) -> tuple:
+        time = np.asarray(time, dtype=np.float64)
+        data = np.asarray(data, dtype=np.float64)
+        t0 = time[0]
+        dt = time - t0
+        # cumulative trapezoid integral of the data
+        integral = np.concatenate(
+            ([0.0], np.cumsum((data[1:] + data[:-1]) * np.diff(time) / 2))
+        )
+        design = np.column_stack((dt, integral))
+        (_, b), *_ = np.linalg.lstsq(design, data - data[0], rcond=None)
+        design = np.column_stack((np.exp(b * dt), np.ones_like(dt)))
+        (a, c), *_ = np.linalg.lstsq(design, data, rcond=None)
+        return (a, b, c, t0)
+
+    def evaluate(self, params, time) -> np.ndarray:
+        a, b, c, t0 = params
+        return a * np.exp(b * (time - t0)) + c
+
+
+class FitService:
+    # LRU cache of fitted parameters.
+    # key = (fitter name, hash of the fitted trace, cutting time window)
+    fitter_dict = {
+        "PolyVal": PolyFitter(2),
+        "Exponential": ExpFitter(),
+        "FastExponential": IntegralExpFitter(),
+    }
+
+    def __init__(self, max_entries=32):
+        self.__max_entries = max_entries
+        self.__cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.__cache)
+
+    # return (fitting curve at eval_time, parameters). The parameters of the same
+    # key are the same object.
+    def fit(self, fitter_name, time, data, eval_time, window=None):
+        fitter = FitService.fitter_dict[fitter_name]
+        key = (
+            fitter_name,
+            FitService.hash_trace(time, data),
+            None if window is None else tuple(window),
+        )
+        params = self.__cache.get(key)
+        if params is None:
+            params = fitter.fit(time, data)
+            self.__cache[key] = params
+            if len(self.__cache) > self.__max_entries:
+                self.__cache.popitem(last=False)
+        else:
+            self.__cache.move_to_end(key)
+        return fitter.evaluate(params, eval_time), params
+
+    @staticmethod
+    def hash_trace(time, data) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (time, data):
+            array = np.ascontiguousarray(array)
+            digest.update(str((array.dtype, array.shape)).encode())
+            digest.update(array.data)
+        return digest.digest()
+
+    def clear(self):
+        self.__cache.clear()
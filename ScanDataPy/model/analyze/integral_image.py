@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Integral image (summed-area table) of frames for rectangle ROI traces.
+A ROI sum of every frame is 4 lookups instead of a sum over the ROI area.
+
+@author: lunelukkio@gmail.com
+"""
+
+import numpy as np
+from ScanDataPy.common_class import Tools
+
+
+class IntegralImage:
+    # sat[i, j, t] = sum of frames[:i, :j, t]. sat[0, :, :] and sat[:, 0, :] are 0.
+    # It is float64 to keep ROI sums exact enough for small ROIs in large frames.
+    CHUNK_BYTES = 64 * 1024**2  # working memory to build it
+
+    def __init__(self, sat: np.ndarray):
+        self._sat = sat  # [x + 1, y + 1, t]
+
+    @property
+    def shape(self) -> tuple:
+        x, y, t = self._sat.shape
+        return (x - 1, y - 1, t)
+
+    @property
+    def nbytes(self) -> int:
+        return self._sat.nbytes
+
+    @staticmethod
+    def estimate_nbytes(shape) -> int:
+        return (shape[0] + 1) * (shape[1] + 1) * shape[2] * 8
+
+    # frames = [x, y, t] ndarray or LazyFrames. It is read chunk by chunk in time.
+    @classmethod
+    def from_frames(cls, frames):
+        num_x, num_y, num_t = frames.shape
+        sat = np.zeros((num_x + 1, num_y + 1, num_t), dtype=np.float64)
+        chunk = max(cls.CHUNK_BYTES // max(num_x * num_y * 8, 1), 1)
+        for start in range(0, num_t, chunk):
+            block = np.asarray(frames[:, :, start : start + chunk])
+            block = np.cumsum(block, axis=0, dtype=np.float64)
+            np.cumsum(block, axis=1, out=sat[1:, 1:, start : start + chunk])
+        return cls(sat)
+
+    # If it is larger than max_bytes, return None. Default is a quarter of the available memory.
+    @classmethod
+    def from_frames_in_memory(cls, frames, max_bytes=None):
+        if max_bytes is None:
+            _, _, available_memory = Tools.get_memory_infor()
+            max_bytes = available_memory // 4
+        if cls.estimate_nbytes(frames.shape) > max_bytes:
+            print("IntegralImage: The frames are too large. Use direct sums.")
+            return None
+        return cls.from_frames(frames)
+
+    # a trace of the sum in roi = [x, y, x_width, y_width] from frame# start to stop.
+    # The roi is clipped to the frames like numpy slicing.
+    def roi_sum(self, x, y, x_width, y_width, start=0, stop=None) -> np.ndarray:
+        return self.rois_sum([[x, y, x_width, y_width]], start, stop)[0]
+
+    def roi_mean(self, x, y, x_width, y_width, start=0, stop=None) -> np.ndarray:
+        return self.rois_mean([[x, y, x_width, y_width]], start, stop)[0]
+
+    # traces of many rois = [[x, y, x_width, y_width], ...] at once. -> [roi, t]
+    def rois_sum(self, rois, start=0, stop=None) -> np.ndarray:
+        x0, y0, x1, y1 = self.__clip_rois(rois)
+        sat = self._sat[:, :, start:stop]
+        return sat[x1, y1] - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]
+
+    # A roi out of the frames is nan.
+    def rois_mean(self, rois, start=0, stop=None) -> np.ndarray:
+        x0, y0, x1, y1 = self.__clip_rois(rois)
+        area = ((x1 - x0) * (y1 - y0))[:, np.newaxis]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.rois_sum(rois, start, stop) / area
+
+    def __clip_rois(self, rois):
+        num_x, num_y, _ = self.shape
+        rois = np.asarray(rois, dtype=np.int64).reshape(-1, 4)
+        x0 = np.clip(rois[:, 0], 0, num_x)
+        y0 = np.clip(rois[:, 1], 0, num_y)
+        x1 = np.clip(rois[:, 0] + rois[:, 2], 0, num_x)
+        y1 = np.clip(rois[:, 1] + rois[:, 3], 0, num_y)
+        return x0, y0, np.maximum(x1, x0), np.maximum(y1, y0)
@@ -15,6 +15,28 @@ from ScanDataPy.model.file_io import DaFileIo
 from ScanDataPy.model.file_io import HekaFileIO
 
 
+# import a JSON setting file. It is used by the builders and DataService.
+def load_file_setting() -> dict:
+    search_paths = [
+        "./setting/file_setting.json",
+        "../setting/file_setting.json",
+        "./ScanDataPy/setting/file_setting.json",
+    ]
+    for path in search_paths:
+        try:
+            with open(path, "r") as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            continue
+        except json.JSONDecodeError:
+            print(f"Error: {path} is not a valid JSON file")
+            continue
+    print("Error: Could not find or load file_setting.json in any of these locations:")
+    for path in search_paths:
+        print(f"- {path}")
+    raise FileNotFoundError("No valid settings file found")
+
+
 # This class define the names of controllers and data
 class TsmBuilder:
 
@@ -30,36 +52,17 @@ class TsmBuilder:
             }
 
         # import a JSON setting file
-        setting = None
-        search_paths = [
-            "./setting/file_setting.json",
-            "../setting/file_setting.json",
-            "./ScanDataPy/setting/file_setting.json"
-        ]
-        
-        for path in search_paths:
-            try:
-                with open(path, "r") as json_file:
-                    setting = json.load(json_file)
-                print(f"Successfully loaded settings from: {path}")
-                break
-            except FileNotFoundError:
-                continue
-            except json.JSONDecodeError:
-                print(f"Error: {path} is not a valid JSON file")
-                continue
-            except Exception as e:
-                print(f"Unexpected error while reading {path}: {str(e)}")
-                continue
-        
-        if setting is None:
-            print("Error: Could not find or load file_setting.json in any of these locations:")
-            for path in search_paths:
-                print(f"- {path}")
-            raise FileNotFoundError("No valid settings file found")
+        setting = load_file_setting()
 
         num_ch = setting["tsm"]["num_ch"]
         num_elec_ch = setting["tsm"]["num_elec_ch"]
+        # lazy_load keeps frames in a memory map of the file. see TsmFileIo
+        lazy = setting["tsm"].get("lazy_load", False)
+        frames_dtype = setting["tsm"].get("frames_dtype", "float32")
+        # sidecar_cache saves decoded data next to the file. see SidecarCache
+        sidecar_cache = setting["tsm"].get("sidecar_cache", False)
+        # lazy_load scales only used elec ch in elec_dtype. see TbnFileIo
+        elec_dtype = setting["tsm"].get("elec_dtype", "float64")
 
         default_dict = setting['tsm'].copy()
 
@@ -69,7 +72,14 @@ class TsmBuilder:
             'Text'
             )
         )
-        file_io = TsmFileIo(filename_obj, num_ch)
+        file_io = TsmFileIo(
+            filename_obj,
+            num_ch,
+            lazy,
+            frames_dtype,
+            sidecar_cache=sidecar_cache,
+            elec_dtype=elec_dtype,
+        )
 
         # header value object
         header = TextData(
@@ -89,7 +99,7 @@ class TsmBuilder:
                 filename_obj.name,
                 'Data',
                 'FluoFramesCh0'
-            ), data_interval[0])
+            ), data_interval[0], is_source=True)
         ]
         # make a ch frames list
         ch_frames = [
@@ -98,15 +108,14 @@ class TsmBuilder:
                     filename_obj.name,
                     'Data',
                     'FluoFramesCh' + str(i)
-                ), data_interval[i]
+                ), data_interval[i], is_source=True
             ) for i in range(1, num_ch + 1)
         ]
         frames = full_frames + ch_frames
-        # make an elec list
-        trace_list = file_io.get_1d()
+        # make an elec list. Each ch is taken alone not to scale every ch.
         elec_trace_list = [
             TraceData(
-                trace_list[:, ch], tag_creator(
+                file_io.get_elec_trace(ch), tag_creator(
                     filename_obj.name,
                     'Data',
                     'ElecTraceCh' + str(ch + 1)
@@ -114,7 +123,9 @@ class TsmBuilder:
             ) for ch in range(num_elec_ch)
         ]
 
-        del file_io  # release the io object to allow file changes during recording.
+        # release the io object to allow file changes during recording.
+        # In lazy_load mode, the frames keep the file mapped until they are deleted.
+        del file_io
 
         # make a list for every value objects. They will be saved by DataService class.
         data_list = [default, header] + frames + elec_trace_list
@@ -137,25 +148,23 @@ class DaBuilder:
             }
 
         # import a JSON setting file
-        try:
-            with open("./setting/file_setting.json", "r") as json_file:
-                setting = json.load(json_file)
-        except:
-            try:
-                with open("../setting/file_setting.json", "r") as json_file:
-                    setting = json.load(json_file)
-            except:
-                with open("ScanDataPy/setting/file_setting.json", "r") as json_file:
-                    setting = json.load(json_file)
+        setting = load_file_setting()
         num_ch = setting["da"]["num_ch"]
         num_elec_ch = setting["da"]["num_elec_ch"]
+        # lazy_load keeps frames in a memory map of the file. see DaFileIo
+        lazy = setting["da"].get("lazy_load", False)
+        frames_dtype = setting["da"].get("frames_dtype", "float32")
+        # sidecar_cache saves decoded data next to the file. see SidecarCache
+        sidecar_cache = setting["da"].get("sidecar_cache", False)
 
         default_dict = setting["da"].copy()
 
         default = TextData(
             default_dict, tag_creator(filename_obj.name, "Default", "Text")
         )
-        file_io = DaFileIo(filename_obj, num_ch)
+        file_io = DaFileIo(
+            filename_obj, num_ch, lazy, frames_dtype, sidecar_cache=sidecar_cache
+        )
 
         # header value object
         header = TextData(
@@ -171,6 +180,7 @@ class DaBuilder:
                 frames_list[0],
                 tag_creator(filename_obj.name, "Data", "FluoFramesCh0"),
                 data_interval[0],
+                is_source=True,
             )
         ]
         # make a ch frames list
@@ -179,6 +189,7 @@ class DaBuilder:
                 frames_list[i],
                 tag_creator(filename_obj.name, "Data", "FluoFramesCh" + str(i)),
                 data_interval[i],
+                is_source=True,
             )
             for i in range(1, num_ch + 1)
         ]
@@ -194,7 +205,9 @@ class DaBuilder:
             for ch in range(num_elec_ch)
         ]
 
-        del file_io  # release the io object to allow file changes during recording.
+        # release the io object to allow file changes during recording.
+        # In lazy_load mode, the frames keep the file mapped until they are deleted.
+        del file_io
 
         # make a list for every value objects. They will be saved by DataService class.
         data_list = [default, header] + frames + elec_trace_list
@@ -206,28 +219,59 @@ class DaBuilder:
 
 
 class HekaBuilder:
-    def __init__(self, filename_obj):
-        file_io = HekaFileIO(filename_obj)
+    @staticmethod
+    def create_data(filename_obj):
+        # 'Sweep' is "G1S1Sw1" for group 1, series 1, sweep 1 of a .dat file.
+        def tag_creator(filename, attribute, data_type, origin="File", sweep=None):
+            tag = {
+                "Filename": filename,
+                "Attribute": attribute,
+                "DataType": data_type,
+                "Origin": origin,
+            }
+            if sweep is not None:
+                tag["Sweep"] = sweep
+            return tag
 
-        # get and set data from files
-        self.data_interval_dict = dict(
-            zip("Meta_data", file_io.get_infor()))  # make an interval dict
-        self.frames = None
-        self.image = None
-        self.elec_data = file_io.get_1d()
-        print(self.data_interval_dict)
+        # import a JSON setting file
+        setting = load_file_setting()
 
-        def get_infor(self, filename_obj):
-            return self.data_interval_dict
+        default_dict = setting["dat"].copy()
 
-        def get_frame(self, filename_obj):
-            print("No frame data")
+        default = TextData(
+            default_dict, tag_creator(filename_obj.name, "Default", "Text")
+        )
+        file_io = HekaFileIO(filename_obj)
 
-        def get_image(self, filename_obj):
-            print("No image data")
+        # header value object
+        header = TextData(
+            file_io.get_header(), tag_creator(filename_obj.name, "Header", "Text")
+        )
 
-        def get_trace(self, filename_obj):
-            return self.elec_data
+        # get and set data from files
+        data_interval = file_io.get_infor()  # get interval infor from the io
+        # lazy traces. They are read at the first access. see HekaTrace
+        trace_list = file_io.get_1d()
+        elec_trace_list = [
+            TraceData(
+                trace,
+                tag_creator(
+                    filename_obj.name,
+                    "Data",
+                    "ElecTraceCh" + str(trace_idx + 1),
+                    sweep=f"G{group_idx + 1}S{series_idx + 1}Sw{sweep_idx + 1}",
+                ),
+                interval,
+            )
+            for trace, interval, (group_idx, series_idx, sweep_idx, trace_idx) in zip(
+                trace_list, data_interval, file_io.get_index()
+            )
+        ]
+
+        # The traces keep the bundle to read data. It is released when every
+        # series is read. see HekaSeries
+        del file_io
 
-        def get_default_data_structure(self, filename_obj):
-            raise NotImplementedError()
+        # make a list for every value objects. They will be saved by DataService class.
+        data_list = [default, header] + elec_trace_list
+        return data_list
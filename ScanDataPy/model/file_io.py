@@ -8,11 +8,21 @@ See def __factory_selector in Experiments class
 see builder factory and builder classes
 """
 
+import os
 import sys
+import json
+import shutil
 
 sys.path.append("../heka_reader-master")
+# heka_reader-master is in the repository root.
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "heka_reader-master"
+    )
+)
 
 import numpy as np
+from struct import error as struct_error
 
 try:
     from heka_reader import Bundle
@@ -20,11 +30,240 @@ except:
     pass
 
 
+# Storage dtype of dark subtracted frames. int16 - int16 can wrap,
+# so only 32 bit or wider integers and floats are accepted.
+def check_frames_dtype(frames_dtype) -> np.dtype:
+    frames_dtype = np.dtype(frames_dtype)
+    if np.issubdtype(frames_dtype, np.floating):
+        return frames_dtype
+    if np.issubdtype(frames_dtype, np.signedinteger) and frames_dtype.itemsize >= 4:
+        return frames_dtype
+    raise ValueError(
+        f"frames_dtype '{frames_dtype}' is not safe for dark frame subtraction. "
+        "Use float32, float64, int32 or int64."
+    )
+
+
+# frames are interleaved as ch1, ch2, ch1, ch2, ... in the time axis.
+# return strided views of frames (ndarray, np.memmap or LazyFrames) for every ch.
+def split_frames(frames, num_ch) -> list:
+    num_frames = frames.shape[2] // num_ch * num_ch
+    return [frames[:, :, ch:num_frames:num_ch] for ch in range(num_ch)]
+
+
+class LazyFrames:
+    # Read-only frames [x, y, t] backed by a np.memmap view of a raw file.
+    # Slicing with slices only narrows the mapped window (e.g. by TimeWindow and Roi)
+    # and reads nothing. The pages of the window are read and the dark frame is
+    # subtracted when the frames are used as an array (e.g. np.mean in Average).
+    def __init__(self, raw_frames, dark_frame, frames_dtype=np.float32):
+        self._raw = raw_frames  # memmap view [x, y, t] without the dark frame
+        self._dark = dark_frame  # [x, y] in memory
+        self._frames_dtype = check_frames_dtype(frames_dtype)
+
+    @property
+    def dark_frame(self):
+        return self._dark
+
+    @property
+    def shape(self) -> tuple:
+        return self._raw.shape
+
+    @property
+    def ndim(self) -> int:
+        return self._raw.ndim
+
+    @property
+    def dtype(self):
+        return self._frames_dtype
+
+    def __len__(self):
+        return self._raw.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        # only basic indexing is read lazily. Others need the whole frames.
+        if len(key) > 3 or not all(
+            isinstance(k, (slice, int, np.integer)) for k in key
+        ):
+            return np.asarray(self)[key]
+        key = key + (slice(None),) * (3 - len(key))
+        if all(isinstance(k, slice) for k in key):
+            # pushdown: keep it lazy with a smaller window.
+            return LazyFrames(
+                self._raw[key], self._dark[key[0], key[1]], self._frames_dtype
+            )
+        block = np.asarray(self._raw[key])
+        dark = self._dark[key[0], key[1]]
+        if isinstance(key[2], slice):  # the frame axis is kept
+            dark = dark[..., np.newaxis]
+        return np.subtract(block, dark, dtype=self._frames_dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        frames = np.subtract(
+            np.asarray(self._raw),
+            self._dark[..., np.newaxis],
+            dtype=self._frames_dtype,
+        )
+        if dtype is not None:
+            frames = frames.astype(dtype)
+        return frames
+
+
+class LazyTrace:
+    # Read-only 1D trace backed by a np.memmap view of a raw file. e.g. a ch of .tbn
+    # The scale is applied in trace_dtype only to the accessed samples,
+    # and slicing returns scaled numpy data.
+    def __init__(self, raw_trace, scale, trace_dtype=np.float64):
+        self._raw = raw_trace  # memmap view [data]
+        self._scale = scale
+        self._trace_dtype = np.dtype(trace_dtype)
+
+    @property
+    def shape(self) -> tuple:
+        return self._raw.shape
+
+    @property
+    def ndim(self) -> int:
+        return 1
+
+    @property
+    def dtype(self):
+        return self._trace_dtype
+
+    def __len__(self):
+        return self._raw.shape[0]
+
+    def __getitem__(self, key):
+        return np.multiply(self._raw[key], self._scale, dtype=self._trace_dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        trace = self[:]
+        if dtype is not None:
+            trace = trace.astype(dtype)
+        return trace
+
+
+class SidecarCache:
+    # On-disk cache of decoded data next to a raw file. e.g. 20408B002.tsm.cache/
+    # Every array is a .npy file and loaded as a read-only np.memmap without copies.
+    # meta.json has the size and mtime of the source files and the decode settings.
+    # If one of them is changed, the cache is invalid and it is made again.
+    # Only full frames and raw elec data are saved. ch frames are views of the
+    # full frames and elec data is scaled again when it is loaded.
+    VERSION = 2
+    CHUNK_BYTES = 256 * 1024**2  # for writing frames without a whole copy
+
+    def __init__(self, source_list: list, settings: dict):
+        self.source_list = source_list  # fullnames of raw files. [.tsm, .tbn]
+        self.settings = settings  # decode settings. e.g. num_fluo_ch, frames_dtype
+        self.cache_dir = source_list[0] + ".cache"
+        self.meta_filename = os.path.join(self.cache_dir, "meta.json")
+
+    def make_meta(self) -> dict:
+        sources = {}
+        for source in self.source_list:
+            stat = os.stat(source)
+            sources[os.path.basename(source)] = [stat.st_size, stat.st_mtime_ns]
+        return {
+            "Version": self.VERSION,
+            "Sources": sources,
+            "Settings": self.settings,
+        }
+
+    # return the saved meta or None if the cache is invalid.
+    def read_meta(self):
+        try:
+            with open(self.meta_filename, "r") as json_file:
+                meta = json.load(json_file)
+            name_list = meta.pop("Arrays")
+            if meta != self.make_meta():
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        meta["Arrays"] = name_list
+        return meta
+
+    def is_valid(self) -> bool:
+        return self.read_meta() is not None
+
+    # return {name: read-only np.memmap} or None if the cache is invalid.
+    def load(self):
+        meta = self.read_meta()
+        if meta is None:
+            return None
+        name_list = meta["Arrays"]
+        try:
+            array_dict = {
+                name: np.load(os.path.join(self.cache_dir, name + ".npy"), mmap_mode="r")
+                for name in name_list
+            }
+        except (OSError, ValueError) as e:
+            print(f"SidecarCache: Failed to load {self.cache_dir}: {str(e)}")
+            return None
+        print(f"SidecarCache: Loaded {self.cache_dir}")
+        return array_dict
+
+    # array_dict = {name: array or LazyFrames}
+    def save(self, array_dict: dict) -> bool:
+        try:
+            # Invalidate and remove the old cache first. meta.json is written
+            # at the end, so an interrupted save leaves an invalid cache.
+            if os.path.isfile(self.meta_filename):
+                os.remove(self.meta_filename)
+            if os.path.isdir(self.cache_dir):
+                shutil.rmtree(self.cache_dir)
+            os.makedirs(self.cache_dir)
+            for name, array in array_dict.items():
+                self.write_array(os.path.join(self.cache_dir, name + ".npy"), array)
+            meta = self.make_meta()
+            meta["Arrays"] = list(array_dict)
+            with open(self.meta_filename, "w") as json_file:
+                json.dump(meta, json_file)
+        except OSError as e:
+            print(f"SidecarCache: Failed to save {self.cache_dir}: {str(e)}")
+            return False
+        print(f"SidecarCache: Saved {self.cache_dir}")
+        return True
+
+    @classmethod
+    def write_array(cls, filename, array):
+        out = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=array.dtype, shape=array.shape
+        )
+        if out.ndim == 3:
+            # copy by chunks of frames. LazyFrames are read chunk by chunk.
+            frame_bytes = max(out[:, :, 0].nbytes, 1)
+            chunk = max(cls.CHUNK_BYTES // frame_bytes, 1)
+            for start in range(0, out.shape[2], chunk):
+                out[:, :, start : start + chunk] = array[:, :, start : start + chunk]
+        else:
+            out[...] = array
+        out.flush()
+        del out
+
+
 class TsmFileIo:
     # load a .tsn file
-    def __init__(self, filename_obj, num_fluo_ch=2):
+    # lazy=True keeps the frames in a np.memmap instead of reading them into RAM.
+    # frames_dtype is the dtype of dark subtracted frames. see check_frames_dtype()
+    # header_only=True reads only the file infor. see get_file_infor()
+    # sidecar_cache=True reuses decoded data in <file>.cache/. see SidecarCache
+    # elec_dtype is the dtype of scaled elec traces. see TbnFileIo
+    def __init__(
+        self,
+        filename_obj,
+        num_fluo_ch=2,
+        lazy=False,
+        frames_dtype=np.float32,
+        header_only=False,
+        sidecar_cache=False,
+        elec_dtype=np.float64,
+    ):
         # about file
         self.filename = filename_obj.name
+        self.extension = filename_obj.extension
         self.file_path = filename_obj.path
         self.full_filename = filename_obj.fullname
         self.header = 0  # byte: it needs to chage to str [self.header.decode()]
@@ -64,13 +303,38 @@ class TsmFileIo:
         self.ch_3D_size = 0
 
         self.object_num = 0  # for counter
+        self.lazy = lazy
+        self.frames_dtype = check_frames_dtype(frames_dtype)
 
         # read data
         self.read_infor()
-        self.read_data()
+        self.sidecar = None
+        cached_dict = None
+        if sidecar_cache and not header_only:
+            self.sidecar = SidecarCache(
+                [self.full_filename, self.full_filename[0:-3] + "tbn"],
+                {
+                    "NumCh": self.num_fluo_ch,
+                    "FramesDtype": self.frames_dtype.name,
+                    "ElecDtype": np.dtype(elec_dtype).name,
+                },
+            )
+            cached_dict = self.sidecar.load()
+        if not header_only and cached_dict is None:
+            self.read_data()
+        # elec data is in the cache, too.
         self.elec_data_obj = TbnFileIo(
-            filename_obj, self.full_frame_interval, self.num_full_frames
+            filename_obj,
+            self.full_frame_interval,
+            self.num_full_frames,
+            header_only or cached_dict is not None,
+            lazy,
+            elec_dtype,
         )
+        if cached_dict is not None:
+            self.set_sidecar_data(cached_dict)
+        elif self.sidecar is not None:
+            self.sidecar.save(self.get_sidecar_data())
 
     def read_infor(self):
         try:
@@ -132,23 +396,35 @@ class TsmFileIo:
                 self.data_pixel[0] * self.data_pixel[1] * self.num_full_frames
             ) + (self.data_pixel[0] * self.data_pixel[1])
 
-            full_with_dark_frame = np.fromfile(
-                path, dtype=file_dtype, count=pixel_count, offset=2880
-            )
             full_dark_framesize = tuple(
-                self.full_3D_size + [0, 0, 1]
+                int(size) for size in self.full_3D_size + [0, 0, 1]
             )  # including dark frame
-            full_with_dark_frame = full_with_dark_frame.reshape(
-                full_dark_framesize, order="F"
-            )
-            full_with_dark_frame = np.rot90(full_with_dark_frame, 3)
-            full_with_dark_frame = np.fliplr(full_with_dark_frame)
-            self.full_frames = full_with_dark_frame[:, :, 0:-1]
-            self.dark_frame = full_with_dark_frame[:, :, -1]
-            # subtract a dark frame from every full frames.
-            self.full_frames = self.full_frames - self.dark_frame[:, :, np.newaxis]
+            if self.lazy:
+                lazy_frames = self.map_frames()
+                self.full_frames = lazy_frames[0]
+                self.ch_frames = list(lazy_frames[1:])
+                self.dark_frame = self.full_frames.dark_frame
+            else:
+                full_with_dark_frame = np.fromfile(
+                    path, dtype=file_dtype, count=pixel_count, offset=2880
+                )
+                full_with_dark_frame = full_with_dark_frame.reshape(
+                    full_dark_framesize, order="F"
+                )
+                full_with_dark_frame = np.rot90(full_with_dark_frame, 3)
+                full_with_dark_frame = np.fliplr(full_with_dark_frame)
+
+                self.full_frames = full_with_dark_frame[:, :, 0:-1]
+                self.dark_frame = full_with_dark_frame[:, :, -1]
+                # subtract a dark frame from every full frames in frames_dtype.
+                self.full_frames = np.subtract(
+                    self.full_frames,
+                    self.dark_frame[:, :, np.newaxis],
+                    dtype=self.frames_dtype,
+                )
 
-            self.ch_frames = self.split_frames(self.full_frames, self.num_fluo_ch)
+                # ch frames are strided views of the full frames.
+                self.ch_frames = split_frames(self.full_frames, self.num_fluo_ch)
 
         except IndexError as tsm_error:
             print(tsm_error)
@@ -160,16 +436,45 @@ class TsmFileIo:
         else:
             print("Imported a TSM imaging data.")
 
-    @staticmethod
-    def split_frames(frames, num_ch):
-        ch_frames = np.empty(
-            [frames.shape[0], frames.shape[1], frames.shape[2] // num_ch, num_ch]
+    # map the file and make LazyFrames of the full frames and every ch.
+    # Nothing is read until frames are used. see LazyFrames
+    def map_frames(self) -> tuple:
+        full_dark_framesize = tuple(
+            int(size) for size in self.full_3D_size + [0, 0, 1]
+        )  # including dark frame
+        full_with_dark_frame = np.memmap(
+            self.full_filename,
+            dtype=np.int16,
+            mode="r",
+            offset=2880,
+            shape=full_dark_framesize,
+            order="F",
+        )
+        # rot90 and fliplr return views. The memmap stays unread.
+        full_with_dark_frame = np.rot90(full_with_dark_frame, 3)
+        full_with_dark_frame = np.fliplr(full_with_dark_frame)
+        dark_frame = np.array(full_with_dark_frame[:, :, -1])
+        raw_frames = full_with_dark_frame[:, :, 0:-1]
+        # every ch is a strided view of the mapped full frames.
+        return tuple(
+            LazyFrames(frames, dark_frame, self.frames_dtype)
+            for frames in [raw_frames]
+            + split_frames(raw_frames, self.num_fluo_ch)
         )
 
-        for i in range(0, num_ch):
-            for j in range(i, frames.shape[2], num_ch):
-                ch_frames[:, :, j // num_ch, i] = frames[:, :, j]
-        return ch_frames  # = [:,:,:,ch]
+    # arrays for SidecarCache. elec data is float64 of the .tbn file.
+    def get_sidecar_data(self) -> dict:
+        return {
+            "full_frames": self.full_frames,
+            "dark_frame": self.dark_frame,
+            "raw_elec": self.elec_data_obj.map_raw_elec(),
+        }
+
+    def set_sidecar_data(self, array_dict: dict):
+        self.full_frames = array_dict["full_frames"]
+        self.dark_frame = array_dict["dark_frame"]
+        self.ch_frames = split_frames(self.full_frames, self.num_fluo_ch)
+        self.elec_data_obj.set_raw_elec(array_dict["raw_elec"])
 
     def get_header(self):
         return self.header
@@ -183,7 +488,7 @@ class TsmFileIo:
         )
 
     def get_3d(self) -> tuple:
-        return self.full_frames, self.ch_frames[:, :, :, 0], self.ch_frames[:, :, :, 1]
+        return (self.full_frames, *self.ch_frames)
 
     def get_2d(self):
         return []
@@ -192,6 +497,25 @@ class TsmFileIo:
         data_1d = self.elec_data_obj.get_data()
         return data_1d
 
+    # a single elec ch. ch starts from 0. see TbnFileIo.get_trace()
+    def get_elec_trace(self, ch):
+        return self.elec_data_obj.get_trace(ch)
+
+    # lightweight record of the file. It doesn't need read_data().
+    def get_file_infor(self) -> dict:
+        return {
+            "Filename": self.filename,
+            "Extension": self.extension,
+            "DataPixel": [int(pixel) for pixel in self.data_pixel],
+            "NumFullFrames": int(self.num_full_frames),
+            "NumCh": self.num_fluo_ch,
+            "FullFrameInterval": float(self.full_frame_interval),
+            "ChFrameInterval": float(self.ch_frame_interval),
+            "NumElecCh": int(self.elec_data_obj.num_elec_ch),
+            "ElecInterval": float(self.elec_data_obj.elec_interval),
+            "BncRatio": int(self.elec_data_obj.bnc_ratio),
+        }
+
     def get_dark_frame(self):
         return self.dark_frame
 
@@ -209,7 +533,17 @@ class TsmFileIo:
 
 
 class TbnFileIo:
-    def __init__(self, filename_obj, full_frame_interval, num_full_frames):
+    # lazy=True maps the file, and every ch is scaled when it is used. see LazyTrace
+    # elec_dtype is the dtype of scaled traces. float32 or float64
+    def __init__(
+        self,
+        filename_obj,
+        full_frame_interval,
+        num_full_frames,
+        header_only=False,
+        lazy=False,
+        elec_dtype=np.float64,
+    ):
         # about file
         self.filename = filename_obj.name
         self.file_path = filename_obj.path
@@ -222,6 +556,7 @@ class TbnFileIo:
         # about elec
         self.elec_header = 0
         self.elec_trace = np.empty([0, 0])  # = [data, ch]
+        self.raw_elec = None  # np.memmap [data, ch] in lazy mode
         self.bnc_ratio = 0
         self.num_elec_ch = 0
         self.elec_interval = 0
@@ -232,32 +567,40 @@ class TbnFileIo:
         # The amp output is Vm*10, and V to mV
         # Output of MaltiClamp700A is 0.5V/nA, and V to pA
         self.elec_gain_table = [1, 20, 1, 1, 1, 1, 1, 1]
+        self.lazy = lazy
+        self.elec_dtype = np.dtype(elec_dtype)
+        if not np.issubdtype(self.elec_dtype, np.floating):
+            raise ValueError(f"elec_dtype should be float. {self.elec_dtype} is given.")
 
         # read data
-        self.read_data()
+        self.elec_full_filename = self.full_filename[0:-3] + ("tbn")
+        self.read_infor()
+        if not header_only:
+            self.read_data()
 
-    def read_data(self):  # from .tbn files
+    def read_infor(self):  # from .tbn files
         try:
             # read a header
             # https://fits.gsfc.nasa.gov/fits_primer.html
-            elec_full_filename = self.full_filename[0:-3] + ("tbn")
-            elec_header_list = np.fromfile(elec_full_filename, np.int16, count=2)
+            elec_header_list = np.fromfile(self.elec_full_filename, np.int16, count=2)
             self.elec_header = elec_header_list
             self.num_elec_ch = elec_header_list[0] * -1
             self.bnc_ratio = elec_header_list[1]
             self.elec_interval = self.full_frame_interval / self.bnc_ratio
             self.num_elec_data = self.num_full_frames * self.bnc_ratio
 
-            # read elec data
-            pre_raw_elec = np.fromfile(elec_full_filename, np.float64, offset=4)
-            self.elec_trace = pre_raw_elec.reshape(
-                self.num_elec_data, self.num_elec_ch, order="F"
-            )
+        except OSError as e:
+            print(e)
+            print("----------------------------------")
+            print("Failed to import a .tbn (Tsm) file")
+            print("----------------------------------")
+            raise Exception("Failed to import a .tbn (Tsm) data.")
 
-            # scale set
-            self.elec_trace = (self.elec_trace / 10 * self.elec_gain_table) * 1000
+    def read_data(self):  # from .tbn files
+        try:
+            self.set_raw_elec(self.map_raw_elec())
 
-        except OSError as e:
+        except (OSError, ValueError) as e:
             print(e)
             print("----------------------------------")
             print("Failed to import a .tbn (Tsm) file")
@@ -267,12 +610,48 @@ class TbnFileIo:
         else:
             print("Imported a .tbn(.tsm) elec data file.")
 
+    # map the file. Every ch is contiguous in the file. = [data, ch]
+    def map_raw_elec(self) -> np.memmap:
+        return np.memmap(
+            self.elec_full_filename,
+            dtype=np.float64,
+            mode="r",
+            offset=4,
+            shape=(int(self.num_elec_data), int(self.num_elec_ch)),
+            order="F",
+        )
+
+    # raw_elec = [data, ch] of the file or SidecarCache. In lazy mode, it is kept
+    # and scaled by LazyTrace. Otherwise, it is scaled here in elec_dtype.
+    def set_raw_elec(self, raw_elec):
+        if self.lazy:
+            self.raw_elec = raw_elec
+            self.elec_trace = None
+            return
+        # scale set
+        self.elec_trace = (np.asarray(raw_elec) / 10 * self.elec_gain_table) * 1000
+        self.elec_trace = self.elec_trace.astype(self.elec_dtype, copy=False)
+
     def get_infor(self):
         return self.elec_interval
 
+    # [data, ch]. In lazy mode, every ch is scaled here.
     def get_data(self):
+        if self.raw_elec is not None:
+            return np.stack(
+                [np.asarray(self.get_trace(ch)) for ch in range(self.num_elec_ch)],
+                axis=1,
+            )
         return self.elec_trace
 
+    # a single ch. ch starts from 0. It is a LazyTrace in lazy mode.
+    def get_trace(self, ch):
+        if self.raw_elec is not None:
+            # The amp output is Vm*10 (V), and V to mV
+            scale = self.elec_gain_table[ch] / 10 * 1000
+            return LazyTrace(self.raw_elec[:, ch], scale, self.elec_dtype)
+        return self.elec_trace[:, ch]
+
     def print_data_infor(self):
         print("elec_header = " + str(self.elec_header))
         print("filenmae = " + self.full_filename)
@@ -284,9 +663,22 @@ class TbnFileIo:
 
 class DaFileIo:
     # load a .da file
-    def __init__(self, filename_obj, num_fluo_ch=2):
+    # lazy=True keeps the frames in a np.memmap instead of reading them into RAM.
+    # frames_dtype is the dtype of dark subtracted frames. see check_frames_dtype()
+    # header_only=True reads only the file infor. see get_file_infor()
+    # sidecar_cache=True reuses decoded data in <file>.cache/. see SidecarCache
+    def __init__(
+        self,
+        filename_obj,
+        num_fluo_ch=2,
+        lazy=False,
+        frames_dtype=np.float32,
+        header_only=False,
+        sidecar_cache=False,
+    ):
         # about file
         self.filename = filename_obj.name
+        self.extension = filename_obj.extension
         self.file_path = filename_obj.path
         self.full_filename = filename_obj.fullname
         self.header = 0  # byte: it needs to chage to str [self.header.decode()]
@@ -336,107 +728,109 @@ class DaFileIo:
         self.num_elec_data = 0
 
         self.object_num = 0  # for counter
+        self.lazy = lazy
+        self.frames_dtype = check_frames_dtype(frames_dtype)
 
         # read data
-        self.read_data()
+        self.read_infor()
+        self.sidecar = None
+        cached_dict = None
+        if sidecar_cache and not header_only:
+            self.sidecar = SidecarCache(
+                [self.full_filename],
+                {"NumCh": self.num_fluo_ch, "FramesDtype": self.frames_dtype.name},
+            )
+            cached_dict = self.sidecar.load()
+        if cached_dict is not None:
+            self.set_sidecar_data(cached_dict)
+        elif not header_only:
+            self.read_data()
+            if self.sidecar is not None:
+                self.sidecar.save(self.get_sidecar_data())
 
-    def read_data(self):
+    def read_infor(self):
         try:
-            with open(self.full_filename, "rb") as f:
-                # redshirt data format
-                # http://www.redshirtimaging.com/support/dfo.html
+            # redshirt data format
+            # http://www.redshirtimaging.com/support/dfo.html
+            path = self.full_filename
 
-                binary_data = f.read()
+            """ read imaging infor """
+            # header is first 5120 bytes (2560 integers)
+            self.header = np.fromfile(path, dtype=np.int16, count=2560)
+            read_data_byte = self.header.nbytes
+            # str_header = self.header.decode()
 
-                """ read imaging infor """
-                # header is first 5120 bytes (2560 integers)
-                self.header = np.frombuffer(
-                    binary_data[:5120], dtype=np.int16
-                )  # header is first 5120 bytes (2560 integers)
-                read_data_byte = self.header.nbytes
-                # str_header = self.header.decode()
+            # x pixel.  97th Integer-6408 80*80+8?
+            num_x = int(self.header[384])  # This should be int, not np.int16
+            # y pixel
+            num_y = int(self.header[385])
 
-                # x pixel.  97th Integer-6408 80*80+8?
-                num_x = int(self.header[384])  # This should be int, not np.int16
-                # y pixel
-                num_y = int(self.header[385])
+            self.data_pixel = np.array([num_x, num_y])
 
-                self.data_pixel = np.array([num_x, num_y])
+            # z: number of frames
+            num_full_frames = int(self.header[4])  # 5th Integer
+            self.num_full_frames = np.array(num_full_frames)
+            self.num_ch_frames = self.num_full_frames // self.num_fluo_ch
+            # Frame Interval (msec per frame) (Number of Pixels*4th Integer)/20000.0 ???
+            self.full_frame_interval = self.header[388] / 1000  # ms
 
-                # z: number of frames
-                self.num_full_frames = np.array(self.header[4])  # 5th Integer
-                self.num_ch_frames = self.num_full_frames // self.num_fluo_ch
-                # Frame Interval (msec per frame) (Number of Pixels*4th Integer)/20000.0 ???
-                self.full_frame_interval = self.header[388] / 1000  # ms
+            self.ch_frame_interval = self.full_frame_interval * self.num_fluo_ch
 
-                self.ch_frame_interval = self.full_frame_interval * self.num_fluo_ch
+            # make frames size information
+            self.full_3D_size = np.append(self.data_pixel, self.num_full_frames)
+            self.ch_3D_size = np.append(
+                self.data_pixel, self.num_full_frames // self.num_fluo_ch
+            )
 
-                # make frames size information
-                self.full_3D_size = np.append(self.data_pixel, self.num_full_frames)
-                self.ch_3D_size = np.append(
-                    self.data_pixel, self.num_full_frames // self.num_fluo_ch
-                )
+            """ read elec infor """
+            self.num_elec_ch = 8  # fixed
+            self.bnc_ratio = int(self.header[391])
+            self.elec_interval = self.full_frame_interval / self.bnc_ratio
+            self.num_elec_data = num_full_frames * self.bnc_ratio
 
-                """ read imaging data"""
-                # data 80*80*100
-                pixel_count = (
-                    self.data_pixel[0] * self.data_pixel[1] * self.num_full_frames
-                )
+        except (IndexError, ValueError, OSError) as da_error:
+            print(da_error)
+            print("------------------------------------")
+            print("Failed to import a .da file infor.")
+            print("------------------------------------")
+            raise Exception("Failed to import a NeuroPlex data.")
 
-                # read data from a file. 5120=header byte.
-                pre_frames = np.frombuffer(
-                    binary_data[read_data_byte : pixel_count * 2 + read_data_byte],
-                    dtype=np.int16,
-                )
-                read_data_byte = read_data_byte + pre_frames.nbytes
-                # container size
-                full_framesize = tuple(self.full_3D_size)  # without dark frame
-                # make a full data.
-                pre_full_frames = pre_frames.reshape(full_framesize, order="C")
-                # pre_full_frames = np.rot90(self.full_frames, 3)
-                # pre_full_frames = np.fliplr(self.full_frames)
-
-                """ read elec data """
-                # read elec data
-                self.num_elec_ch = 8  # fixed
-                self.bnc_ratio = self.header[391]
-                self.elec_interval = self.full_frame_interval / self.bnc_ratio
-                self.num_elec_data = self.num_full_frames * self.bnc_ratio
-                self.elec_trace = np.empty([self.num_elec_data, 8])  # = [data, ch]
-
-                for ch in range(8):
-                    data = np.frombuffer(
-                        binary_data[
-                            read_data_byte : read_data_byte + self.num_elec_data * 2
-                        ],
-                        dtype=np.int16,
-                    )
-                    read_data_byte = read_data_byte + data.nbytes
-                    data = data / 32678
-                    data = data * 1000  # convert AtoD values to mV
-                    self.elec_trace[:, ch] = data
-
-                """ read dark frame """
-                # make dark frame
-                pre_dark_frame = np.frombuffer(
-                    binary_data[
-                        read_data_byte : read_data_byte
-                        + self.data_pixel[0] * self.data_pixel[1] * 2
-                    ],
-                    dtype=np.int16,
-                )
-                # dark frame reshape
-                self.dark_frame = pre_dark_frame.reshape(
-                    self.data_pixel[0], self.data_pixel[1]
+    def read_data(self):
+        try:
+            # Every block is read through np.memmap with offsets in the file,
+            # so the file is never held in memory as a whole bytes object.
+            """ read imaging data"""
+            # data 80*80*100. 5120=header byte.
+            pre_full_frames = self.map_raw_frames()
+            # pre_full_frames = np.rot90(self.full_frames, 3)
+            # pre_full_frames = np.fliplr(self.full_frames)
+
+            """ read elec data """
+            self.elec_trace = self.scale_elec(self.map_raw_elec())
+
+            """ read dark frame """
+            # make dark frame
+            self.dark_frame = self.read_dark_frame()
+
+            if self.lazy:
+                lazy_frames = self.map_frames()
+                self.full_frames = lazy_frames[0]
+                self.ch_frames = list(lazy_frames[1:])
+            else:
+                # make full frames subtructed by a dark frame in frames_dtype
+                # This is the only copy of the image block.
+                self.full_frames = np.subtract(
+                    pre_full_frames,
+                    self.dark_frame[:, :, np.newaxis],
+                    dtype=self.frames_dtype,
                 )
 
-                # make full frames subtructed by a dark frame
-                self.full_frames = pre_full_frames - self.dark_frame[:, :, np.newaxis]
-
-                # spilit ch data
-                self.ch_frames = self.split_frames(self.full_frames, self.num_fluo_ch)
+                # spilit ch data. ch frames are strided views of the full frames.
+                self.ch_frames = split_frames(
+                    self.full_frames, self.num_fluo_ch
+                )
 
-        except IndexError as da_error:
+        except (IndexError, ValueError) as da_error:
             print(da_error)
             print("------------------------------------")
             print("Failed to import a .da data.")
@@ -446,16 +840,76 @@ class DaFileIo:
         else:
             print("Imported a NeuroPlex imaging data.")
 
+    # the image block is after the header. [x, y, t] without dark frame
+    def map_raw_frames(self) -> np.memmap:
+        return np.memmap(
+            self.full_filename,
+            dtype=np.int16,
+            mode="r",
+            offset=self.header.nbytes,
+            shape=tuple(int(size) for size in self.full_3D_size),
+            order="C",
+        )
+
+    # 8 ch are stored one after another after the image block. [ch, data]
+    def map_raw_elec(self) -> np.memmap:
+        num_x, num_y = (int(pixel) for pixel in self.data_pixel)
+        return np.memmap(
+            self.full_filename,
+            dtype=np.int16,
+            mode="r",
+            offset=self.header.nbytes + num_x * num_y * int(self.num_full_frames) * 2,
+            shape=(self.num_elec_ch, self.num_elec_data),
+        )
+
+    # convert AtoD values to mV in one pass. [ch, data] -> [data, ch]
     @staticmethod
-    def split_frames(frames, num_ch):
-        ch_frames = np.empty(
-            [frames.shape[0], frames.shape[1], frames.shape[2] // num_ch, num_ch]
+    def scale_elec(raw_elec) -> np.ndarray:
+        return np.multiply(np.asarray(raw_elec).T, 1000 / 32678, dtype=np.float64)
+
+    # the dark frame is after the image block and 8 elec ch.
+    def read_dark_frame(self) -> np.ndarray:
+        num_x, num_y = (int(pixel) for pixel in self.data_pixel)
+        dark_frame_offset = (
+            self.header.nbytes
+            + num_x * num_y * int(self.num_full_frames) * 2
+            + self.num_elec_ch * self.num_elec_data * 2
+        )
+        return np.array(
+            np.memmap(
+                self.full_filename,
+                dtype=np.int16,
+                mode="r",
+                offset=dark_frame_offset,
+                shape=(num_x, num_y),
+            )
         )
 
-        for i in range(0, num_ch):
-            for j in range(i, frames.shape[2], num_ch):
-                ch_frames[:, :, j // num_ch, i] = frames[:, :, j]
-        return ch_frames  # = [:,:,:,ch]
+    # map the file and make LazyFrames of the full frames and every ch.
+    # Nothing is read until frames are used. see LazyFrames
+    def map_frames(self) -> tuple:
+        raw_frames = self.map_raw_frames()
+        dark_frame = self.read_dark_frame()
+        # every ch is a strided view of the mapped full frames.
+        return tuple(
+            LazyFrames(frames, dark_frame, self.frames_dtype)
+            for frames in [raw_frames]
+            + split_frames(raw_frames, self.num_fluo_ch)
+        )
+
+    # arrays for SidecarCache. elec data is int16 of the file.
+    def get_sidecar_data(self) -> dict:
+        return {
+            "full_frames": self.full_frames,
+            "dark_frame": self.dark_frame,
+            "raw_elec": self.map_raw_elec(),
+        }
+
+    def set_sidecar_data(self, array_dict: dict):
+        self.full_frames = array_dict["full_frames"]
+        self.dark_frame = array_dict["dark_frame"]
+        self.ch_frames = split_frames(self.full_frames, self.num_fluo_ch)
+        self.elec_trace = self.scale_elec(array_dict["raw_elec"])
 
     def get_header(self):
         return self.header
@@ -468,7 +922,7 @@ class DaFileIo:
         )
 
     def get_3d(self) -> tuple:
-        return self.full_frames, self.ch_frames[:, :, :, 0], self.ch_frames[:, :, :, 1]
+        return (self.full_frames, *self.ch_frames)
 
     def get_2d(self):
         return []
@@ -476,6 +930,21 @@ class DaFileIo:
     def get_1d(self):
         return self.elec_trace
 
+    # lightweight record of the file. It doesn't need read_data().
+    def get_file_infor(self) -> dict:
+        return {
+            "Filename": self.filename,
+            "Extension": self.extension,
+            "DataPixel": [int(pixel) for pixel in self.data_pixel],
+            "NumFullFrames": int(self.num_full_frames),
+            "NumCh": self.num_fluo_ch,
+            "FullFrameInterval": float(self.full_frame_interval),
+            "ChFrameInterval": float(self.ch_frame_interval),
+            "NumElecCh": int(self.num_elec_ch),
+            "ElecInterval": float(self.elec_interval),
+            "BncRatio": int(self.bnc_ratio),
+        }
+
     def print_data_infor(self):
         # print(self.header.decode())
         print("filenmae = " + self.full_filename)
@@ -489,21 +958,192 @@ class DaFileIo:
         print("data_pixel = " + str(self.data_pixel))
 
 
+class HekaSeries:
+    # Every sweep of one trace in a series of a .dat file. [sweep, data]
+    # All sweeps are read and scaled at once at the first access and kept.
+    # The bundle is released after the read. The file is unmapped when every
+    # series of the file is read (or deleted).
+    def __init__(self, bundle, group, series, trace, scale=1.0):
+        self._bundle = bundle
+        self._index = (group, series, trace)
+        self._scale = scale  # unit conversion. e.g. V to mV
+        self._data = None
+
+    # a read-only view like ValueObj
+    def read(self) -> np.ndarray:
+        if self._data is None:
+            self._data = self._bundle.data.series(*self._index) * self._scale
+            self._data.flags.writeable = False
+            self._bundle = None
+        return self._data.view()
+
+
+class HekaTrace:
+    # Read-only 1D trace of a .dat file. It is a sweep of a HekaSeries, so the first
+    # access reads every sweep of the series together. The shape is known from
+    # the .pul tree without reading.
+    def __init__(self, series, sweep, num_data_points):
+        self._series = series  # HekaSeries
+        self._sweep = sweep
+        self._shape = (int(num_data_points),)
+
+    @property
+    def shape(self) -> tuple:
+        return self._shape
+
+    @property
+    def ndim(self) -> int:
+        return 1
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+
+    def __len__(self):
+        return self._shape[0]
+
+    # a read-only view of the series
+    def read(self) -> np.ndarray:
+        return self._series.read()[self._sweep, : self._shape[0]]
+
+    def __getitem__(self, key):
+        return self.read()[key]
+
+    def __array__(self, dtype=None, copy=None):
+        trace = self.read()
+        if dtype is not None:
+            trace = trace.astype(dtype)
+        return trace
+
+
 class HekaFileIO:
+    # load a .dat file of HEKA PatchMaster
+    # The .pul tree is walked once into a flat index of traces.
+    # Trace data is read by HekaTrace only when it is used.
+    # units are changed to the same as .tbn. V to mV, A to pA
+    unit_scale_dict = {"V": 1000, "A": 10**12}
+    unit_dict = {"V": "mV", "A": "pA"}
+
     def __init__(self, filename_obj):
-        filename = filename_obj.name
-        file_path = filename_obj.path
-        full_filename = filename_obj.fullname
-        self.bundle = Bundle(full_filename)
+        # about file
+        self.filename = filename_obj.name
+        self.extension = filename_obj.extension
+        self.file_path = filename_obj.path
+        self.full_filename = filename_obj.fullname
 
-        self.trace = bundle.pul[group_ind][series_ind][sweep_ind][trace_ind]
-        self.data = bundle.data[group_id, series_id, sweep_ind, trace_ind]
+        self.bundle = None
+        self.trace_index = []  # [(group, series, sweep, trace)]
+        self.trace_infor = []  # [dict] in the same order as trace_index
+        self.series_dict = {}  # {(group, series, trace): HekaSeries}
 
-        print("Under construction")
-        print(trace)
+        # read data
+        self.read_infor()
 
-    def get_infor(self):
-        return self.trace
+    def read_infor(self):
+        try:
+            self.bundle = Bundle(self.full_filename)
+            pul = self.bundle.pul
+            for group_idx, group in enumerate(pul):
+                for series_idx, series in enumerate(group):
+                    for sweep_idx, sweep in enumerate(series):
+                        for trace_idx, trace in enumerate(sweep):
+                            self.trace_index.append(
+                                (group_idx, series_idx, sweep_idx, trace_idx)
+                            )
+                            self.trace_infor.append(
+                                {
+                                    "GroupLabel": group.Label,
+                                    "SeriesLabel": series.Label,
+                                    "SweepLabel": sweep.Label,
+                                    "Label": trace.Label,
+                                    "DataPoints": trace.DataPoints,
+                                    "XInterval": trace.XInterval * 1000,  # s to ms
+                                    "YUnit": trace.YUnit,
+                                }
+                            )
+        except (OSError, RuntimeError, struct_error) as heka_error:
+            print(heka_error)
+            print("------------------------------------")
+            print("Failed to import a .dat data.")
+            print("------------------------------------")
+            raise Exception("Failed to import a HEKA data.")
 
-    def get_1d(self):
-        return self.data
+        else:
+            print(f"Imported a HEKA file infor. {len(self.trace_index)} traces.")
+
+    def get_header(self) -> dict:
+        return {
+            "Version": self.bundle.header.Version,
+            "Time": self.bundle.header.Time,
+            "NumTraces": len(self.trace_index),
+        }
+
+    # [group, series, sweep, trace] of every trace
+    def get_index(self) -> list:
+        return self.trace_index
+
+    # interval (ms) of every trace
+    def get_infor(self) -> list:
+        return [infor["XInterval"] for infor in self.trace_infor]
+
+    # lazy traces of every trace. Nothing is read here.
+    def get_1d(self) -> list:
+        return [self.get_trace(num) for num in range(len(self.trace_index))]
+
+    # num is the number in trace_index
+    def get_trace(self, num) -> HekaTrace:
+        group_idx, series_idx, sweep_idx, trace_idx = self.trace_index[num]
+        series = self.get_series_obj(group_idx, series_idx, trace_idx)
+        return HekaTrace(series, sweep_idx, self.trace_infor[num]["DataPoints"])
+
+    # sweeps of a trace share a HekaSeries to be read together.
+    def get_series_obj(self, group_idx, series_idx, trace_idx) -> HekaSeries:
+        key = (group_idx, series_idx, trace_idx)
+        if key not in self.series_dict:
+            unit = self.bundle.pul[group_idx][series_idx][0][trace_idx].YUnit
+            self.series_dict[key] = HekaSeries(
+                self.bundle, *key, self.unit_scale_dict.get(unit, 1.0)
+            )
+        return self.series_dict[key]
+
+    # every sweep of a trace in a series. [sweep, data] NaN pads short sweeps.
+    def get_series(self, group_idx, series_idx, trace_idx) -> np.ndarray:
+        return self.get_series_obj(group_idx, series_idx, trace_idx).read()
+
+    def print_data_infor(self):
+        print("filenmae = " + self.full_filename)
+        print("num_traces = " + str(len(self.trace_index)))
+
+
+class FileProbe:
+    # Read only headers and return a lightweight record of the file.
+    # e.g. FileProbe.probe(WholeFilename('20408B002.tsm'))
+    @staticmethod
+    def probe(filename_obj, num_fluo_ch=2) -> dict:
+        extension = filename_obj.extension
+        if extension == ".tsm":
+            return TsmFileIo(
+                filename_obj, num_fluo_ch, header_only=True
+            ).get_file_infor()
+        elif extension == ".tbn":
+            # .tbn needs the frame infor of the .tsm with the same name.
+            tsm_filename_obj = type(filename_obj)(filename_obj.fullname[0:-3] + "tsm")
+            return FileProbe.probe(tsm_filename_obj, num_fluo_ch)
+        elif extension == ".da":
+            return DaFileIo(
+                filename_obj, num_fluo_ch, header_only=True
+            ).get_file_infor()
+        elif extension == ".dat":
+            # Only the bundle header. The .pul tree is not parsed.
+            with Bundle(filename_obj.fullname) as bundle:
+                return {
+                    "Filename": filename_obj.name,
+                    "Extension": extension,
+                    "Version": bundle.header.Version,
+                    "Time": bundle.header.Time,
+                    "BundleItems": [
+                        item for item in bundle.catalog.keys() if item != ""
+                    ],
+                }
+        else:
+            raise Exception(f"FileProbe: {extension} is an undefineded file!!!")
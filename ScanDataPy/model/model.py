@@ -7,6 +7,12 @@ Created on Thu Aug 29 14:49:22 2024
 
 from abc import ABCMeta, abstractmethod
 import copy
+import os
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import CancelledError, FIRST_COMPLETED, wait
 from logging import raiseExceptions
 
 from ScanDataPy.common_class import Tools
@@ -15,6 +21,10 @@ from ScanDataPy.model.modifier import ModifierService
 from ScanDataPy.model.builder import TsmBuilder
 from ScanDataPy.model.builder import DaBuilder
 from ScanDataPy.model.builder import HekaBuilder
+from ScanDataPy.model.builder import load_file_setting
+from ScanDataPy.model.file_io import FileProbe
+from ScanDataPy.model.file_io import split_frames
+from ScanDataPy.model.value_object import FramesData
 
 
 class ModelInterface(metaclass=ABCMeta):
@@ -47,6 +57,16 @@ class ModelInterface(metaclass=ABCMeta):
     def get_data(self, data_tag, modifier_list_list=None):
         raise NotImplementedError()
 
+    # return a list of value objects. request_list = [(data_tag, modifier_list), ...]
+    @abstractmethod
+    def get_data_many(self, request_list):
+        raise NotImplementedError()
+
+    # True if the modifiers don't use the observers and can run in threads.
+    @abstractmethod
+    def is_thread_safe(self, modifier_list) -> bool:
+        raise NotImplementedError()
+
     @abstractmethod
     def get_list_of_repository_tag_dict(self, filename_key):
         raise NotImplementedError()
@@ -78,37 +98,123 @@ class ModelInterface(metaclass=ABCMeta):
         raise NotImplementedError()
 
 
+def builder_selector(filename_obj):
+    if filename_obj.extension == ".tsm":
+        return TsmBuilder()
+    elif filename_obj.extension == ".tbn":
+        raise Exception("Select a .tsm file instead of a .tbn file!!!")
+    elif filename_obj.extension == ".da":
+        return DaBuilder()
+    elif filename_obj.extension == ".dat":
+        return HekaBuilder()
+    else:
+        raise Exception("This file is an undefineded file!!!")
+
+
+# make value objects from a file. It is a top-level function for process pools.
+def build_data(fullname) -> list:
+    filename_obj = WholeFilename(fullname)
+    builder = builder_selector(filename_obj)
+    return builder.create_data(filename_obj)
+
+
+# build_data for process pools. Ch frames are views of the full frames, but each
+# of them would be a copy in a pickle. Only the full frames are sent, and the ch
+# frames are sent as [(index, data_tag, interval, pixel_size, is_source), ...]
+def build_data_in_process(fullname) -> tuple:
+    data_list = build_data(fullname)
+    ch_list = [
+        (index, data.data_tag, data.interval, data.pixel_size, data.is_source)
+        for index, data in enumerate(data_list)
+        if isinstance(data, FramesData)
+        and data.data_tag["DataType"].startswith("FluoFramesCh")
+        and data.data_tag["DataType"] != "FluoFramesCh0"
+    ]
+    ch_index_set = {index for index, *_ in ch_list}
+    data_list = [
+        data for index, data in enumerate(data_list) if index not in ch_index_set
+    ]
+    return data_list, ch_list
+
+
+# make the ch frames of build_data_in_process() again as views of the full frames
+def join_ch_frames(data_list, ch_list) -> list:
+    data_list = list(data_list)
+    if not ch_list:
+        return data_list
+    full_frames = next(
+        data
+        for data in data_list
+        if isinstance(data, FramesData)
+        and data.data_tag["DataType"] == "FluoFramesCh0"
+    )
+    ch_frames_list = split_frames(full_frames.data, len(ch_list))
+    # in the order of the index to put them back to the same places
+    for (index, data_tag, interval, pixel_size, is_source), ch_frames in zip(
+        ch_list, ch_frames_list
+    ):
+        data_list.insert(
+            index,
+            FramesData(
+                ch_frames, data_tag, interval, pixel_size, is_source=is_source
+            ),
+        )
+    return data_list
+
+
 class DataService(ModelInterface):
     def __init__(self):
         # repository for Roi, TimeWindow, DFoF
         self.__data_repository = Repository()
         self.__modifier_service = ModifierService()
+        # It is kept through reset() to step through files in a folder.
+        self._prefetch_service = PrefetchService(build_data)
+        # for get_data_many(). NumPy reductions release the GIL. made at the first use
+        self._thread_pool = None
 
     def __create_filename_obj(self, fullname):
         filename_obj = WholeFilename(fullname)
         return filename_obj
 
-    def __builder_selector(self, filename_obj):
-        if filename_obj.extension == ".tsm":
-            return TsmBuilder()
-        elif filename_obj.extension == ".tbn":
-            raise Exception("Select a .tsm file instead of a .tbn file!!!")
-        elif filename_obj.extension == ".da":
-            return DaBuilder()
-        elif filename_obj.extension == ".dat":
-            return HekaBuilder()
-        else:
-            raise Exception("This file is an undefineded file!!!")
+    # estimated peak memory to build value objects of a file. 0 if unknown.
+    @staticmethod
+    def __estimate_nbytes(filename_obj, setting) -> int:
+        try:
+            file_infor = FileProbe.probe(filename_obj)
+        except Exception:
+            return 0
+        if "DataPixel" not in file_infor:
+            return os.path.getsize(filename_obj.fullname)
+        num_x, num_y = file_infor["DataPixel"]
+        num_pixel = num_x * num_y * (file_infor["NumFullFrames"] + 1)
+        # int16 raw data and frames in frames_dtype at most during decoding
+        frames_dtype = setting.get(filename_obj.extension[1:], {}).get(
+            "frames_dtype", "float32"
+        )
+        return num_pixel * (2 + np.dtype(frames_dtype).itemsize)
+
+    # Value objects of .dat files keep the Bundle, and memory mapped frames
+    # (lazy_load, sidecar_cache) become copies without the file in a pickle.
+    # Only eager .tsm and .da files are built in a process.
+    @staticmethod
+    def __can_build_in_process(filename_obj, setting) -> bool:
+        if filename_obj.extension not in (".tsm", ".da"):
+            return False
+        file_setting = setting.get(filename_obj.extension[1:], {})
+        return not (
+            file_setting.get("lazy_load", False)
+            or file_setting.get("sidecar_cache", False)
+        )
 
     def create_experiments(self,
                            fullname):  # Use the same name to delete a model
         # make a filename value obj from fullname
-        filename_obj = self.__create_filename_obj(fullname)
+        fullname = self.__create_filename_obj(fullname).fullname
 
-        # create default data set.
-        builder = self.__builder_selector(filename_obj)
-        # make value objects from a file.
-        data_list = builder.create_data(filename_obj)
+        # use prefetched data if it is there. Otherwise, read the file.
+        data_list = self._prefetch_service.get(fullname)
+        if data_list is None:
+            data_list = build_data(fullname)
         for data in data_list:
             self._repository.save(data)
         print("")
@@ -118,6 +224,75 @@ class DataService(ModelInterface):
         print("")
         return True
 
+    # load files in a process pool. The number of files in progress is limited
+    # by memory_budget (bytes). Files which can't be sent from a process are
+    # loaded in this process. return {fullname: True or False}
+    def create_experiments_many(
+        self, fullname_list, max_workers=None, memory_budget=None
+    ) -> dict:
+        filename_obj_list = [
+            self.__create_filename_obj(fullname) for fullname in fullname_list
+        ]
+        if memory_budget is None:
+            # a half of the available memory
+            _, _, available_memory = Tools.get_memory_infor()
+            memory_budget = available_memory // 2
+        setting = load_file_setting()
+        waiting = deque(
+            (filename_obj.fullname, self.__estimate_nbytes(filename_obj, setting))
+            for filename_obj in filename_obj_list
+            if self.__can_build_in_process(filename_obj, setting)
+        )
+        local_list = [
+            filename_obj.fullname
+            for filename_obj in filename_obj_list
+            if not self.__can_build_in_process(filename_obj, setting)
+        ]
+        # in the order of fullname_list
+        result_dict = {filename_obj.fullname: False for filename_obj in filename_obj_list}
+        running = {}  # {future: (fullname, nbytes)}
+        running_nbytes = 0
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while waiting or running or local_list:
+                # A file is always loaded even if it is over the budget.
+                while waiting and (
+                    not running or running_nbytes + waiting[0][1] <= memory_budget
+                ):
+                    fullname, nbytes = waiting.popleft()
+                    running[executor.submit(build_data_in_process, fullname)] = (
+                        fullname,
+                        nbytes,
+                    )
+                    running_nbytes += nbytes
+                # while the processes are working
+                if local_list:
+                    fullname = local_list.pop(0)
+                    try:
+                        data_list = build_data(fullname)
+                    except Exception as e:
+                        print(f"DataService: Failed to load {fullname}: {str(e)}")
+                    else:
+                        for data in data_list:
+                            self._repository.save(data)
+                        result_dict[fullname] = True
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fullname, nbytes = running.pop(future)
+                    running_nbytes -= nbytes
+                    try:
+                        data_list = join_ch_frames(*future.result())
+                    except Exception as e:
+                        print(f"DataService: Failed to load {fullname}: {str(e)}")
+                        continue
+                    for data in data_list:
+                        self._repository.save(data)
+                    result_dict[fullname] = True
+        print(
+            f"DataService: Created {sum(result_dict.values())}/{len(result_dict)} expriments data."
+        )
+        return result_dict
+
     def add_modifier(self, modifier_name):
         self._modifier_service.add_chain(modifier_name)
 
@@ -145,6 +320,47 @@ class DataService(ModelInterface):
         print("----------> Dataservice: get_data Done")
         return modified_value_obj
 
+    # Independent requests (e.g. Ch1 and Ch2, or files) run in the thread pool at
+    # the same time. Requests with modifiers using the observers (BlComp, DifImage)
+    # run in this thread, because the observers use the controllers and Qt.
+    # request_list = [(data_tag, modifier_list), ...] -> value objects in the same order
+    def get_data_many(self, request_list) -> list:
+        request_list = list(request_list)
+        is_parallel_list = [
+            self.is_thread_safe(modifier_list) for _, modifier_list in request_list
+        ]
+        # no need of threads for a single request
+        if sum(is_parallel_list) <= 1:
+            return [
+                self.get_data(data_tag, modifier_list)
+                for data_tag, modifier_list in request_list
+            ]
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=min(8, os.cpu_count() or 1),
+                thread_name_prefix="DataService",
+            )
+        future_dict = {
+            i: self._thread_pool.submit(self.get_data, data_tag, modifier_list)
+            for i, ((data_tag, modifier_list), is_parallel) in enumerate(
+                zip(request_list, is_parallel_list)
+            )
+            if is_parallel
+        }
+        result_list = [None] * len(request_list)
+        try:
+            # while the pool is working
+            for i, (data_tag, modifier_list) in enumerate(request_list):
+                if i not in future_dict:
+                    result_list[i] = self.get_data(data_tag, modifier_list)
+            for i, future in future_dict.items():
+                result_list[i] = future.result()
+            return result_list
+        finally:
+            # don't leave the rest running after an error
+            for future in future_dict.values():
+                future.cancel()
+
     def __create_data(self, data_tag, modifier_list=None):
         # get data from repository
         data_list = self._repository.find_by_keys(data_tag)
@@ -167,9 +383,22 @@ class DataService(ModelInterface):
 
         return modified_data
 
+    def is_thread_safe(self, modifier_list) -> bool:
+        return modifier_list is None or self._modifier_service.is_thread_safe(
+            modifier_list
+        )
+
     def get_list_of_repository_tag_dict(self):
         return self._repository.get_list_of_tag_dict()
 
+    # load files in the background for the next create_experiments().
+    def prefetch(self, fullname_list):
+        fullname_list = [
+            self.__create_filename_obj(fullname).fullname
+            for fullname in fullname_list
+        ]
+        self._prefetch_service.prefetch(fullname_list)
+
     def set_observer(self, modifier_tag, observer):
         print(f"DataService: set_observer ({observer.__class__.__name__} to {modifier_tag}) ---------->")
         found = False
@@ -188,9 +417,22 @@ class DataService(ModelInterface):
     def get_modifier_val(self, modifier_name):
         return self._modifier_service.get_modifier_val(modifier_name)
 
+    # The prefetched files are kept for the next create_experiments().
     def reset(self):
         self._repository = Repository()
         self._modifier_service = ModifierService()
+        self.__shutdown_thread_pool()
+
+    # stop the threads of get_data_many() and the prefetch, and release the
+    # prefetched data. They are made again when needed.
+    def shutdown(self):
+        self.__shutdown_thread_pool()
+        self._prefetch_service.shutdown()
+
+    def __shutdown_thread_pool(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True, cancel_futures=True)
+            self._thread_pool = None
 
     def print_infor(self, tag_dict=None, except_dict=None):
         print("Dataservice: print_infor ---------->")
@@ -204,6 +446,144 @@ class DataService(ModelInterface):
         print("----------> Dataservice: print_infor END")
         print("")
 
+"""
+Prefetch
+"""
+
+
+# Build value objects of files in a background worker and keep them in a bounded
+# LRU cache. e.g. Open A002 -> prefetch A001 and A003
+# The size and mtime of the files are kept with the data. If the file was changed
+# (e.g. recorded again), the data is thrown away like SidecarCache.
+class PrefetchService:
+    def __init__(self, build_func, max_entries=3, max_bytes=None):
+        self._build_func = build_func  # fullname -> list of value objects
+        self._max_entries = max_entries
+        if max_bytes is None:
+            # a quarter of the available memory
+            _, _, available_memory = Tools.get_memory_infor()
+            max_bytes = available_memory // 4
+        self._max_bytes = max_bytes
+        self._cache = OrderedDict()  # {fullname: (data_list, nbytes, file_stamp)}
+        self._futures = {}  # {fullname: future}. Only wanted files are here.
+        self._lock = threading.Lock()
+        self._executor = None  # made at the first prefetch
+
+    # submit files which are not in the cache. Pending files which are not in
+    # fullname_list are cancelled.
+    def prefetch(self, fullname_list):
+        with self._lock:
+            for fullname in list(self._futures):
+                if fullname not in fullname_list:
+                    # A running build can not be stopped. It is thrown away in __build.
+                    self._futures.pop(fullname).cancel()
+            for fullname in fullname_list:
+                if fullname in self._cache or fullname in self._futures:
+                    continue
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="PrefetchService"
+                    )
+                self._futures[fullname] = self._executor.submit(
+                    self.__build, fullname
+                )
+                print(f"PrefetchService: Prefetching {fullname}")
+
+    def __build(self, fullname):
+        # before reading. A change during the build makes the data invalid.
+        file_stamp = PrefetchService.file_stamp(fullname)
+        data_list = self._build_func(fullname)
+        with self._lock:
+            wanted = self._futures.pop(fullname, None) is not None
+        if wanted:
+            self.put(fullname, data_list, file_stamp)
+        return data_list, file_stamp
+
+    # (size, mtime) of the file and the .tbn file of a .tsm file.
+    # None if the file is not there.
+    @staticmethod
+    def file_stamp(fullname):
+        source_list = [fullname]
+        if fullname.lower().endswith(".tsm"):
+            source_list.append(fullname[0:-3] + "tbn")
+        stamp = []
+        for source in source_list:
+            try:
+                stat = os.stat(source)
+            except OSError:
+                if source == fullname:
+                    return None
+                continue
+            stamp.append((stat.st_size, stat.st_mtime_ns))
+        return tuple(stamp)
+
+    # return a list of value objects or None. Wait for a prefetch in progress.
+    def get(self, fullname):
+        file_stamp = PrefetchService.file_stamp(fullname)
+        with self._lock:
+            if fullname in self._cache:
+                data_list, _, cached_stamp = self._cache[fullname]
+                if cached_stamp != file_stamp or file_stamp is None:
+                    del self._cache[fullname]
+                    print(f"PrefetchService: {fullname} was changed. Read it again.")
+                    return None
+                self._cache.move_to_end(fullname)
+                print(f"PrefetchService: Use prefetched {fullname}")
+                return list(data_list)
+            future = self._futures.get(fullname)
+        if future is None:
+            return None
+        try:
+            data_list, cached_stamp = future.result()
+        except CancelledError:
+            return None
+        except Exception as e:
+            print(f"PrefetchService: Failed to prefetch {fullname}: {str(e)}")
+            return None
+        if cached_stamp != file_stamp or file_stamp is None:
+            with self._lock:
+                self._cache.pop(fullname, None)
+            print(f"PrefetchService: {fullname} was changed. Read it again.")
+            return None
+        print(f"PrefetchService: Use prefetched {fullname}")
+        return list(data_list)
+
+    def put(self, fullname, data_list, file_stamp):
+        # count each buffer once. ch frames are views of the full frames, and
+        # memory mapped frames don't use memory.
+        nbytes = sum(
+            {id(data.owner): data.owner_nbytes for data in data_list}.values()
+        )
+        if nbytes > self._max_bytes:
+            return
+        with self._lock:
+            self._cache[fullname] = (list(data_list), nbytes, file_stamp)
+            self._cache.move_to_end(fullname)
+            # remove the least recently used files
+            while len(self._cache) > self._max_entries or (
+                sum(item[1] for item in self._cache.values()) > self._max_bytes
+            ):
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures = {}
+            self._cache = OrderedDict()
+
+    # cancel pending files, release the cache and stop the worker. A running
+    # build is waited for and thrown away in __build.
+    def shutdown(self):
+        self.clear()
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        # not in the lock. __build takes it at the end.
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
 """
 Repository
 """
@@ -9,18 +9,24 @@ is not stable.
 @author: lunelukkio
 """
 
+import threading
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 
 import numpy as np
 import itertools
-from scipy.optimize import curve_fit
+from scipy import sparse
 import pyqtgraph as pg
 
 from ScanDataPy.model.value_object import FramesData
 from ScanDataPy.model.value_object import ImageData
 from ScanDataPy.model.value_object import TraceData
+from ScanDataPy.model.value_object import TracesData
 from ScanDataPy.model.value_object import RoiVal
+from ScanDataPy.model.value_object import MultiRoiVal
 from ScanDataPy.model.value_object import TimeWindowVal
+from ScanDataPy.model.analyze.integral_image import IntegralImage
+from ScanDataPy.model.analyze.fitting import FitService
 from ScanDataPy.common_class import Tools
 
 
@@ -53,19 +59,73 @@ class ModifierService(ModifierServiceInterface):
         self.__modifier_chain = ModifierService.make_modifier_chain(
             self.__modifier_chain_list
         )
+        # modified data of the same request is reused. see ResultCache
+        self.__result_cache = ResultCache()
+        # compiled modifier lists. see ExecutionPlan
+        self.__plan_dict = {}
+        # for the caches. apply_modifier can run in threads.
+        self.__lock = threading.Lock()
 
     @property
     def modifier_chain_list(self):
         return self.__modifier_chain_list
 
+    @property
+    def result_cache(self):
+        return self.__result_cache
+
     # This is actual method run by DataService and return a modified value object data
     def apply_modifier(self, data_obj, original_modifier_list=None):
-        # copy modifier list for error checking in EndModifier class
-        modifier_list = original_modifier_list.copy()
-        # start the chain of responsibility and get modified data
-        modified_data = self.__start_modifier.apply_modifier(data_obj, modifier_list)
+        # the same data, modifiers and modifier values return the cached data.
+        cache_key = self.__make_cache_key(data_obj, original_modifier_list)
+        if cache_key is not None:
+            with self.__lock:
+                modified_data = self.__result_cache.get(cache_key, data_obj)
+            if modified_data is not None:
+                return modified_data
+        # run the modifiers in the chain order
+        modified_data = self.__get_plan(original_modifier_list).run(data_obj)
+        if cache_key is not None and modified_data is not None:
+            with self.__lock:
+                self.__result_cache.put(cache_key, data_obj, modified_data)
         return modified_data
 
+    # True if all modifiers in the list can run in a worker thread.
+    def is_thread_safe(self, modifier_list) -> bool:
+        modifier_dict = {
+            modifier_obj.modifier_name: modifier_obj
+            for modifier_obj in self.__modifier_chain_list
+        }
+        return all(
+            name in modifier_dict and modifier_dict[name].thread_safe
+            for name in modifier_list
+        )
+
+    # (source data id, modifier names, modifier versions) or None if not cacheable
+    def __make_cache_key(self, data_obj, modifier_list):
+        modifier_dict = {
+            modifier_obj.modifier_name: modifier_obj
+            for modifier_obj in self.__modifier_chain_list
+        }
+        name_list = sorted(modifier_list)
+        version_list = []
+        for name in name_list:
+            modifier_obj = modifier_dict.get(name)
+            if modifier_obj is None or not modifier_obj.cacheable:
+                return None
+            version_list.append(modifier_obj.version)
+        return (id(data_obj), tuple(name_list), tuple(version_list))
+
+    # The plan of the same modifier list is made only once.
+    def __get_plan(self, modifier_list):
+        plan_key = tuple(sorted(modifier_list))
+        with self.__lock:
+            plan = self.__plan_dict.get(plan_key)
+            if plan is None:
+                plan = ExecutionPlan.compile(self.__modifier_chain_list, modifier_list)
+                self.__plan_dict[plan_key] = plan
+        return plan
+
     def add_chain(self, modifier_name):
         # get a modifier factory
         modifier_factory = ModifierService.check_modifier_type(modifier_name)
@@ -86,6 +146,9 @@ class ModifierService(ModifierServiceInterface):
         self.__modifier_chain = ModifierService.make_modifier_chain(
             self.__modifier_chain_list
         )
+        # new modifier objects start from version 0
+        self.__result_cache.clear()
+        self.__plan_dict.clear()
 
     def remove_chain(self, modifier_name):
         # remove modifier_name object from the list
@@ -102,6 +165,9 @@ class ModifierService(ModifierServiceInterface):
         self.__modifier_chain = ModifierService.make_modifier_chain(
             self.__modifier_chain_list
         )
+        # new modifier objects start from version 0
+        self.__result_cache.clear()
+        self.__plan_dict.clear()
 
     # return modifier value_object taken for ROIBOX
     def get_modifier_val(self, modifier_name):
@@ -113,6 +179,8 @@ class ModifierService(ModifierServiceInterface):
         for modifier_obj in self.__modifier_chain_list:
             if modifier_name == modifier_obj.modifier_name:
                 modifier_obj.set_modifier_val(*args, **kwargs)
+                # cached data made with the old value is not used anymore.
+                modifier_obj.version += 1
                 break
         else:
             raise ValueError(
@@ -121,8 +189,16 @@ class ModifierService(ModifierServiceInterface):
 
     @staticmethod
     def check_modifier_type(modifier_name):
-        if "TimeWindow" in modifier_name:
+        if "TemporalBin" in modifier_name:
+            return TemporalBinFactory()
+        elif "SpatialBin" in modifier_name:
+            return SpatialBinFactory()
+        elif "TimeWindow" in modifier_name:
             return TimeWindowFactory()
+        elif "ActivationMap" in modifier_name:
+            return ActivationMapFactory()
+        elif "MultiRoi" in modifier_name:  # before "Roi"
+            return MultiRoiFactory()
         elif "Roi" in modifier_name:
             return RoiFactory()
         elif "Average" in modifier_name:
@@ -156,7 +232,11 @@ class ModifierService(ModifierServiceInterface):
     def sort_chain_list(old_obj_list):
         new_order_word_list = [
             "StartModifier",
+            "TemporalBin",
+            "SpatialBin",
             "TimeWindow",
+            "ActivationMap",
+            "MultiRoi",
             "Roi",
             "Average",
             "BlComp",
@@ -209,6 +289,172 @@ class ModifierService(ModifierServiceInterface):
         print("")
 
 
+class ResultCache:
+    # LRU cache of modified value objects for ModifierService.apply_modifier.
+    # key = (id of source data, modifier names, modifier versions)
+    # The source data is kept in the entry, so the id can not be reused.
+    # Views keep the buffer of their owner, so the memory of each owner is counted
+    # once while an entry has it. Memory mapped owners don't use memory.
+    def __init__(self, max_entries=64, max_bytes=512 * 1024**2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()  # {key: (source data, modified data, owner id)}
+        self._owners = {}  # {owner id: [owner, the number of entries, nbytes]}
+        self._nbytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, source_obj):
+        entry = self._cache.get(key)
+        if entry is None or entry[0] is not source_obj:
+            return None
+        self._cache.move_to_end(key)
+        print(f"ResultCache: Use cached data {list(entry[1].data_tag.values())}")
+        return entry[1]
+
+    def put(self, key, source_obj, modified_obj):
+        owner = modified_obj.owner
+        nbytes = modified_obj.owner_nbytes
+        if nbytes > self.max_bytes:
+            return
+        if key in self._cache:
+            self.__release(self._cache.pop(key)[2])
+        owner_id = None
+        if owner is not None:
+            owner_id = id(owner)
+            if owner_id in self._owners:
+                self._owners[owner_id][1] += 1
+            else:
+                self._owners[owner_id] = [owner, 1, nbytes]
+                self._nbytes += nbytes
+        self._cache[key] = (source_obj, modified_obj, owner_id)
+        # remove the least recently used data
+        while len(self._cache) > self.max_entries or self._nbytes > self.max_bytes:
+            _, (_, _, old_owner_id) = self._cache.popitem(last=False)
+            self.__release(old_owner_id)
+
+    # the memory of an owner is freed when the last entry of it is removed
+    def __release(self, owner_id):
+        if owner_id is None:
+            return
+        owner_infor = self._owners[owner_id]
+        owner_infor[1] -= 1
+        if owner_infor[1] == 0:
+            self._nbytes -= owner_infor[2]
+            del self._owners[owner_id]
+
+    def clear(self):
+        self._cache = OrderedDict()
+        self._owners = {}
+        self._nbytes = 0
+
+
+class ExecutionPlan:
+    # Modifiers of a modifier list in the chain order. It is made once for each list
+    # by ModifierService, so the chain is not walked at every request.
+    # [TimeWindow ->] Roi -> Average in a row are fused into a RoiTraceStep.
+    def __init__(self, step_list):
+        self.__step_list = step_list
+
+    @property
+    def step_list(self) -> list:
+        return self.__step_list
+
+    @staticmethod
+    def compile(modifier_chain_list, modifier_list):
+        modifier_obj_list = [
+            modifier_obj
+            for modifier_obj in modifier_chain_list
+            if modifier_obj.modifier_name in modifier_list
+        ]
+        # the same check as EndModifier
+        unused_list = [
+            name
+            for name in modifier_list
+            if name not in [obj.modifier_name for obj in modifier_obj_list]
+        ]
+        assert unused_list == [], (
+            f"EndModifier: Modifier Error. {unused_list} didn't use."
+        )
+        step_list = []
+        i = 0
+        while i < len(modifier_obj_list):
+            # [TimeWindow, Roi, Average] or [Roi, Average]
+            for pattern in ((TimeWindow, Roi, Average), (Roi, Average)):
+                part = modifier_obj_list[i : i + len(pattern)]
+                if len(part) == len(pattern) and all(
+                    isinstance(obj, cls) for obj, cls in zip(part, pattern)
+                ):
+                    step_list.append(RoiTraceStep(*([None] * (3 - len(part)) + part)))
+                    i += len(part)
+                    break
+            else:
+                step_list.append(modifier_obj_list[i])
+                i += 1
+        return ExecutionPlan(step_list)
+
+    def run(self, data_obj):
+        for step in self.__step_list:
+            data_obj = step.set_data(data_obj)
+        return data_obj
+
+
+class RoiTraceStep:
+    # TimeWindow (optional), Roi and Average('Roi') in one step. The ROI trace is
+    # made from the window of the frames without the intermediate FramesData.
+    # If the data or the Average mode is different, the modifiers run one by one.
+    def __init__(self, time_window, roi, average):
+        self.time_window = time_window
+        self.roi = roi
+        self.average = average
+
+    def set_data(self, frames_obj):
+        if (
+            frames_obj is None
+            or self.average.average_mode != "Roi"
+            or all("FluoFrames" not in tag for tag in frames_obj.data_tag.values())
+        ):
+            for modifier_obj in (self.time_window, self.roi, self.average):
+                if modifier_obj is not None:
+                    frames_obj = modifier_obj.set_data(frames_obj)
+            return frames_obj
+        # time window
+        start, stop = 0, None
+        if self.time_window is not None:
+            TimeWindow.check_frames_val(frames_obj, self.time_window.val_obj)
+            start, width = self.time_window.val_obj.data
+            if width != -1 and width != 0:
+                stop = start + width
+        # roi
+        Roi.check_val(frames_obj, self.roi.val_obj)
+        x, y, x_width, y_width = self.roi.val_obj.data[:4]
+        data = frames_obj.data[x : x + x_width, y : y + y_width, start:stop]
+        base, (base_x, base_y, base_t) = frames_obj.get_origin()
+        mean_data = Average.sliced_mean_trace(
+            base, (base_x + x, base_y + y, base_t + start), data
+        )
+        print(
+            f"Roi+Average: A trace from {self.roi.val_obj.data} "
+            f"in frame# {start} to {stop} (None means the end)"
+        )
+        ch, data_type = Tools.take_ch_from_str(frames_obj.data_tag["DataType"])
+        return TraceData(
+            mean_data,
+            {
+                "Filename": frames_obj.data_tag["Filename"],
+                "Attribute": "Data",
+                "DataType": "FluoTrace" + ch,
+                "Origin": self.roi.modifier_name,
+            },
+            frames_obj.interval,
+        )
+
+
 """ abstract factory """
 
 
@@ -221,6 +467,16 @@ class ModifierFactory(metaclass=ABCMeta):
 """concrete factory"""
 
 
+class TemporalBinFactory(ModifierFactory):
+    def create_modifier(self, modifier_name):
+        return TemporalBin(modifier_name)
+
+
+class SpatialBinFactory(ModifierFactory):
+    def create_modifier(self, modifier_name):
+        return SpatialBin(modifier_name)
+
+
 class TimeWindowFactory(ModifierFactory):
     def create_modifier(self, modifier_name):
         return TimeWindow(modifier_name)
@@ -231,6 +487,16 @@ class RoiFactory(ModifierFactory):
         return Roi(modifier_name)
 
 
+class ActivationMapFactory(ModifierFactory):
+    def create_modifier(self, modifier_name):
+        return ActivationMap(modifier_name)
+
+
+class MultiRoiFactory(ModifierFactory):
+    def create_modifier(self, modifier_name):
+        return MultiRoi(modifier_name)
+
+
 class AverageFactory(ModifierFactory):
     def create_modifier(self, modifier_name):
         return Average(modifier_name)
@@ -269,7 +535,8 @@ class ModifierHandler(metaclass=ABCMeta):  # BaseHandler
         self.__modifier_name = modifier_name
         self.__next_modifier = None
         self._val_obj = None
-        self.observer = Observer()
+        self.observer = Observer(modifier_name)
+        self.version = 0  # count up by ModifierService.set_modifier_val()
 
     def __del__(self):  # make a message when this object is deleted.
         print(".")
@@ -305,6 +572,17 @@ class ModifierHandler(metaclass=ABCMeta):  # BaseHandler
     def val_obj(self):
         return self._val_obj
 
+    # False if the result depends on anything else than the input and the value.
+    @property
+    def cacheable(self) -> bool:
+        return True
+
+    # False if set_data uses the observers (controllers and Qt). It should run in
+    # the main thread. see DataService.get_data_many
+    @property
+    def thread_safe(self) -> bool:
+        return True
+
     @abstractmethod
     def set_modifier_val(self, *args, **kwargs):
         raise NotImplementedError()
@@ -340,6 +618,122 @@ class StartModifier(ModifierHandler):
         raise NotImplementedError()
 
 
+class TemporalBin(ModifierHandler):
+    # mean of every bin_factor frames or data points. It is the first modifier, so
+    # the later modifiers get smaller data. Frame numbers of TimeWindow are also
+    # binned numbers. The tail which is less than bin_factor is not used.
+    def __init__(self, modifier_name):
+        super().__init__(modifier_name)
+        self.bin_factor = 1
+
+    def __del__(self):  # make a message when this object is deleted.
+        print(".")
+        print(f"----- Deleted a TemporalBin object. + {format(id(self))}")
+        # pass
+
+    def set_modifier_val(self, val: int):
+        self.bin_factor = check_bin_factor(val)
+        print(f"set TemporalBin: {self.bin_factor}")
+
+    def set_data(self, origin_data):
+        if origin_data is None:
+            raise Exception("TemporalBin: origin_data is empty.")
+        n = self.bin_factor
+        if n == 1 or not isinstance(origin_data, (FramesData, TraceData)):
+            return origin_data
+        data = origin_data.data
+        num_bin = data.shape[-1] // n
+        if num_bin == 0:
+            raise ValueError(
+                f"TemporalBin: The bin factor {n} is larger than the data "
+                f"length {data.shape[-1]}"
+            )
+        dtype = np.result_type(data.dtype, np.float32)  # float32 or float64
+        binned_data = np.empty(data.shape[:-1] + (num_bin,), dtype=dtype)
+        # read a chunk of whole bins at once
+        frame_bytes = int(np.prod(data.shape[:-1])) * dtype.itemsize
+        chunk = max(IntegralImage.CHUNK_BYTES // max(frame_bytes * n, 1), 1)
+        for start in range(0, num_bin, chunk):
+            stop = min(start + chunk, num_bin)
+            key = (slice(None),) * (data.ndim - 1) + (slice(start * n, stop * n),)
+            block = np.asarray(data[key], dtype=dtype)
+            block = block.reshape(block.shape[:-1] + (stop - start, n))
+            np.mean(block, axis=-1, dtype=dtype, out=binned_data[..., start:stop])
+        print(f"TemporalBin: {data.shape[-1]} -> {num_bin} by {n}")
+        data_tag = dict(origin_data.data_tag, Origin=self.modifier_name)
+        if isinstance(origin_data, FramesData):
+            return FramesData(
+                binned_data,
+                data_tag,
+                origin_data.interval * n,
+                origin_data.pixel_size,
+            )
+        return TraceData(binned_data, data_tag, origin_data.interval * n)
+
+
+class SpatialBin(ModifierHandler):
+    # mean of every bin_factor x bin_factor pixels of frames and images.
+    # The edge pixels which are less than bin_factor are not used.
+    def __init__(self, modifier_name):
+        super().__init__(modifier_name)
+        self.bin_factor = 1
+
+    def __del__(self):  # make a message when this object is deleted.
+        print(".")
+        print(f"----- Deleted a SpatialBin object. + {format(id(self))}")
+        # pass
+
+    def set_modifier_val(self, val: int):
+        self.bin_factor = check_bin_factor(val)
+        print(f"set SpatialBin: {self.bin_factor}")
+
+    def set_data(self, origin_data):
+        if origin_data is None:
+            raise Exception("SpatialBin: origin_data is empty.")
+        n = self.bin_factor
+        if n == 1 or not isinstance(origin_data, (FramesData, ImageData)):
+            return origin_data
+        data = origin_data.data
+        num_x, num_y = data.shape[0] // n, data.shape[1] // n
+        if num_x == 0 or num_y == 0:
+            raise ValueError(
+                f"SpatialBin: The bin factor {n} is larger than the image "
+                f"size {data.shape[:2]}"
+            )
+        dtype = np.result_type(data.dtype, np.float32)  # float32 or float64
+        binned_data = np.empty((num_x, num_y) + data.shape[2:], dtype=dtype)
+        if data.ndim == 2:  # image
+            data = data[:, :, np.newaxis]
+            out = binned_data[:, :, np.newaxis]
+        else:
+            out = binned_data
+        # read frames in time chunks
+        frame_bytes = data.shape[0] * data.shape[1] * dtype.itemsize
+        chunk = max(IntegralImage.CHUNK_BYTES // max(frame_bytes, 1), 1)
+        for start in range(0, data.shape[2], chunk):
+            block = np.asarray(
+                data[: num_x * n, : num_y * n, start : start + chunk], dtype=dtype
+            )
+            block = block.reshape(num_x, n, num_y, n, block.shape[2])
+            np.mean(
+                block, axis=(1, 3), dtype=dtype, out=out[:, :, start : start + chunk]
+            )
+        print(f"SpatialBin: {origin_data.shape[:2]} -> {(num_x, num_y)} by {n}")
+        data_tag = dict(origin_data.data_tag, Origin=self.modifier_name)
+        pixel_size = origin_data.pixel_size
+        if pixel_size is not None:
+            pixel_size = pixel_size * n
+        if isinstance(origin_data, FramesData):
+            return FramesData(binned_data, data_tag, origin_data.interval, pixel_size)
+        return ImageData(binned_data, data_tag, pixel_size)
+
+
+def check_bin_factor(val) -> int:
+    if isinstance(val, bool) or not isinstance(val, (int, np.integer)) or val < 1:
+        raise ValueError(f"The bin factor should be an int of 1 or more -> {val}")
+    return int(val)
+
+
 class TimeWindow(ModifierHandler):
     def __init__(self, modifier_name):
         super().__init__(modifier_name)
@@ -376,6 +770,8 @@ class TimeWindow(ModifierHandler):
             )
             # take Ch from DataType
             ch, data_type = Tools.take_ch_from_str(origin_data.data_tag["DataType"])
+            # keep the original frames for the integral image. see Average
+            base, (x, y, t) = origin_data.get_origin()
             return FramesData(
                 data,
                 {
@@ -386,6 +782,8 @@ class TimeWindow(ModifierHandler):
                 },
                 origin_data.interval,
                 origin_data.pixel_size,
+                base,
+                (x, y, t + start),
             )
         elif any("ElecTrace" in str for str in list(origin_data.data_tag.values())):
             TimeWindow.check_trace_val(origin_data, self._val_obj)
@@ -503,6 +901,8 @@ class Roi(ModifierHandler):
         print(f"Roi:        A frames from {roi_obj.data}")
         # take Ch from DataType
         ch, data_type = Tools.take_ch_from_str(origin_data.data_tag["DataType"])
+        # keep the original frames for the integral image. see Average
+        base, (base_x, base_y, base_t) = origin_data.get_origin()
         new_data = FramesData(
             data,
             {
@@ -512,6 +912,9 @@ class Roi(ModifierHandler):
                 "Origin": self.modifier_name,
             },
             origin_data.interval,
+            None,
+            base,
+            (base_x + x, base_y + y, base_t),
         )
         return new_data
 
@@ -544,6 +947,259 @@ class Roi(ModifierHandler):
         self.set_modifier_val([40, 40, 1, 1])
 
 
+class ActivationMap(ModifierHandler):
+    # dF/F (%) of each pixel. F0 is the mean of each pixel in the baseline window.
+    # 'Frames' makes dF/F FramesData, 'Peak' and 'Mean' make the max or mean of
+    # dF/F as ImageData. Frames are read in time chunks and calculated in float32.
+    def __init__(self, modifier_name):
+        super().__init__(modifier_name)
+        self.map_mode = "Frames"  # or 'Peak' or 'Mean'
+        self._val_obj = TimeWindowVal(0, 4)  # the same as Tools.f_value
+
+    def __del__(self):  # make a message when this object is deleted.
+        print(".")
+        print(f"----- Deleted a ActivationMap object. + {format(id(self))}")
+        # pass
+
+    def set_modifier_val(self, val):  # mode or baseline window = [start, width]
+        if isinstance(val, str):
+            if val not in ("Frames", "Peak", "Mean"):
+                raise ValueError(f"No such a ActivationMap mode -> {val}")
+            self.map_mode = val
+            print(f"set ActivationMap: {self.map_mode}")
+        elif isinstance(val, list):
+            start, width = val
+            self._val_obj = TimeWindowVal(start, width)
+            print(f"set ActivationMap: baseline window {self._val_obj.data}")
+        else:
+            raise ValueError(f"value: '{val}' should be a string or a list")
+        self.observer.notify_observer()
+
+    def set_data(self, origin_data):
+        if origin_data is None:
+            raise Exception("ActivationMap: origin_data is empty.")
+        elif all(
+            "FluoFrames" not in tag for tag in list(origin_data.data_tag.values())
+        ):
+            return
+        TimeWindow.check_frames_val(origin_data, self._val_obj)
+        frames = origin_data.data
+        num_x, num_y, num_t = origin_data.shape
+        f0 = ActivationMap.baseline_image(frames, *self._val_obj.data)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = np.float32(100) / f0  # dF/F(%) = (F - F0) * 100 / F0
+        if self.map_mode == "Frames":
+            map_data = np.empty((num_x, num_y, num_t), dtype=np.float32)
+        elif self.map_mode == "Peak":
+            map_data = np.full((num_x, num_y), -np.inf, dtype=np.float32)
+        else:
+            map_data = np.zeros((num_x, num_y), dtype=np.float32)
+        chunk = ActivationMap.chunk_size(origin_data.shape)
+        for start in range(0, num_t, chunk):
+            if self.map_mode == "Frames":  # calculate in the output
+                block = map_data[:, :, start : start + chunk]
+                block[...] = frames[:, :, start : start + chunk]
+            else:
+                block = np.array(frames[:, :, start : start + chunk], dtype=np.float32)
+            np.subtract(block, f0[:, :, np.newaxis], out=block)
+            np.multiply(block, scale[:, :, np.newaxis], out=block)
+            if self.map_mode == "Peak":
+                np.maximum(map_data, np.max(block, axis=2), out=map_data)
+            elif self.map_mode == "Mean":
+                map_data += np.sum(block, axis=2, dtype=np.float32)
+        print(
+            f"ActivationMap: dF/F {self.map_mode} with baseline {self._val_obj.data}"
+        )
+        ch, data_type = Tools.take_ch_from_str(origin_data.data_tag["DataType"])
+        if self.map_mode == "Frames":
+            return FramesData(
+                map_data,
+                {
+                    "Filename": origin_data.data_tag["Filename"],
+                    "Attribute": "Data",
+                    "DataType": origin_data.data_tag["DataType"],
+                    "Origin": self.modifier_name,
+                },
+                origin_data.interval,
+                origin_data.pixel_size,
+            )
+        if self.map_mode == "Mean":
+            map_data /= np.float32(num_t)
+        return ImageData(
+            map_data,
+            {
+                "Filename": origin_data.data_tag["Filename"],
+                "Attribute": "Data",
+                "DataType": "FluoImage" + ch,
+                "Origin": self.modifier_name,
+            },
+            origin_data.pixel_size,
+        )
+
+    # F0 image (float32). The window is [start, width] and width -1 is to the end.
+    @staticmethod
+    def baseline_image(frames, start, width) -> np.ndarray:
+        stop = frames.shape[2] if width == -1 or width == 0 else start + width
+        f0 = np.zeros(frames.shape[:2], dtype=np.float32)
+        chunk = ActivationMap.chunk_size(frames.shape)
+        for chunk_start in range(start, stop, chunk):
+            block = frames[:, :, chunk_start : min(chunk_start + chunk, stop)]
+            f0 += np.sum(block, axis=2, dtype=np.float32)
+        f0 /= np.float32(stop - start)
+        return f0
+
+    # the number of frames in a float32 chunk of IntegralImage.CHUNK_BYTES
+    @staticmethod
+    def chunk_size(shape) -> int:
+        return max(IntegralImage.CHUNK_BYTES // max(shape[0] * shape[1] * 4, 1), 1)
+
+
+class MultiRoi(ModifierHandler):
+    # Mean traces of many rois from a frames in one pass. It is Roi + Average for
+    # all rois, and makes a TracesData [roi, t].
+    def __init__(self, modifier_name):
+        super().__init__(modifier_name)
+        self._val_obj = MultiRoiVal(rois=[])
+
+    def __del__(self):  # make a message when this object is deleted.
+        print(".")
+        print(f"----- Deleted a MultiRoi object. + {format(id(self))}")
+        # pass
+
+    # val = [[x, y, x_width, y_width], ...] or a label mask ndarray (x, y)
+    def set_modifier_val(self, val):
+        if isinstance(val, np.ndarray):
+            self._val_obj = MultiRoiVal(label_mask=val)
+        else:
+            self._val_obj = MultiRoiVal(rois=val)
+        self.observer.notify_observer()
+        print(f"set MultiRoi: {self._val_obj.num_rois} rois ({self._val_obj.mode}) and notified")
+
+    def set_data(self, origin_data: object):
+        if origin_data is None:
+            raise Exception("MultiRoi: origin_data is empty.")
+        elif all(
+            "FluoFrames" not in tag for tag in list(origin_data.data_tag.values())
+        ):
+            return
+        if self._val_obj.mode == "Rect":
+            mean_data = MultiRoi.rect_traces(origin_data, self._val_obj.data)
+        else:
+            mean_data = MultiRoi.label_traces(origin_data, self._val_obj.data)
+        # the same dtype as Average
+        if np.issubdtype(origin_data.data.dtype, np.floating):
+            mean_data = mean_data.astype(origin_data.data.dtype)
+        print(f"MultiRoi:   {mean_data.shape[0]} traces from a FluoFrames")
+        # take Ch from DataType
+        ch, data_type = Tools.take_ch_from_str(origin_data.data_tag["DataType"])
+        return TracesData(
+            mean_data,
+            {
+                "Filename": origin_data.data_tag["Filename"],
+                "Attribute": "Data",
+                "DataType": "FluoTraces" + ch,
+                "Origin": self.modifier_name,
+            },
+            origin_data.interval,
+        )
+
+    # rectangle rois from the integral image of the source frames. Other frames
+    # (e.g. from TemporalBin) don't keep the table, so the rois are made by a sparse
+    # averaging matrix [roi, pixel] @ frames [pixel, t] like label_traces.
+    @staticmethod
+    def rect_traces(frames_obj, rois) -> np.ndarray:
+        num_x, num_y, num_t = frames_obj.shape
+        # clip in this frames
+        rois = rois.copy()
+        x1 = np.clip(rois[:, 0] + rois[:, 2], 0, num_x)
+        y1 = np.clip(rois[:, 1] + rois[:, 3], 0, num_y)
+        rois[:, 0] = np.clip(rois[:, 0], 0, num_x)
+        rois[:, 1] = np.clip(rois[:, 1], 0, num_y)
+        rois[:, 2] = np.maximum(x1 - rois[:, 0], 0)
+        rois[:, 3] = np.maximum(y1 - rois[:, 1], 0)
+        base, (x, y, t) = frames_obj.get_origin()
+        integral_image = base.integral_image
+        if integral_image is not None:
+            # shift to the original frames
+            rois[:, 0] += x
+            rois[:, 1] += y
+            return integral_image.rois_mean(rois, t, t + num_t)
+        # pixel indexes of each roi. Rois can overlap.
+        row_list = []
+        pixel_list = []
+        for i, (roi_x, roi_y, x_width, y_width) in enumerate(rois):
+            pixels = (
+                np.arange(roi_x, roi_x + x_width)[:, np.newaxis] * num_y
+                + np.arange(roi_y, roi_y + y_width)
+            ).ravel()
+            row_list.append(np.full(pixels.size, i))
+            pixel_list.append(pixels)
+        rows = np.concatenate(row_list) if row_list else np.zeros(0, dtype=int)
+        pixels = np.concatenate(pixel_list) if pixel_list else np.zeros(0, dtype=int)
+        counts = rois[:, 2] * rois[:, 3]
+        dtype = MultiRoi.mean_dtype(frames_obj.data)
+        mean_matrix = sparse.csr_matrix(
+            ((1 / counts[rows]).astype(dtype), (rows, pixels)),
+            shape=(rois.shape[0], num_x * num_y),
+        )
+        mean_data = MultiRoi.matrix_traces(frames_obj.data, mean_matrix, dtype)
+        mean_data[counts == 0] = np.nan
+        return mean_data
+
+    # label rois by a sparse averaging matrix [label, pixel] @ frames [pixel, t].
+    # -> [label - 1, t]. A label without pixels is nan.
+    @staticmethod
+    def label_traces(frames_obj, label_mask) -> np.ndarray:
+        num_x, num_y, num_t = frames_obj.shape
+        if label_mask.shape != (num_x, num_y):
+            raise ValueError(
+                f"MultiRoi: The label mask {label_mask.shape} is not the same "
+                f"size as the frames {(num_x, num_y)}"
+            )
+        labels = label_mask.ravel()
+        num_labels = int(labels.max(initial=0))
+        pixels = np.flatnonzero(labels > 0)
+        counts = np.bincount(labels[pixels], minlength=num_labels + 1)
+        dtype = MultiRoi.mean_dtype(frames_obj.data)
+        mean_matrix = sparse.csr_matrix(
+            (
+                (1 / counts[labels[pixels]]).astype(dtype),
+                (labels[pixels] - 1, pixels),
+            ),
+            shape=(num_labels, num_x * num_y),
+        )
+        mean_data = MultiRoi.matrix_traces(frames_obj.data, mean_matrix, dtype)
+        mean_data[counts[1:] == 0] = np.nan
+        return mean_data
+
+    # floating frames are averaged in their dtype, and integers in float64
+    @staticmethod
+    def mean_dtype(frames):
+        if np.issubdtype(frames.dtype, np.floating):
+            return frames.dtype
+        return np.float64
+
+    # mean_matrix [roi, pixel] @ frames [pixel, t] in one product for frames in
+    # memory, and in time chunks for memmap or LazyFrames.
+    @staticmethod
+    def matrix_traces(frames, mean_matrix, dtype) -> np.ndarray:
+        num_x, num_y, num_t = frames.shape
+        mean_data = np.empty((mean_matrix.shape[0], num_t), dtype=np.float64)
+        if type(frames) is np.ndarray:  # already in memory
+            chunk = max(num_t, 1)
+        else:  # memmap or LazyFrames
+            chunk = max(IntegralImage.CHUNK_BYTES // max(num_x * num_y * 8, 1), 1)
+        for start in range(0, num_t, chunk):
+            block = np.asarray(frames[:, :, start : start + chunk], dtype=dtype)
+            mean_data[:, start : start + chunk] = mean_matrix @ block.reshape(
+                num_x * num_y, -1
+            )
+        return mean_data
+
+    def reset(self) -> None:
+        self.set_modifier_val([])
+
+
 class Average(ModifierHandler):
     def __init__(self, modifier_name):
         super().__init__(modifier_name)
@@ -582,7 +1238,7 @@ class Average(ModifierHandler):
             )
         if self.average_mode == "Roi":
             # mean to trace
-            mean_data = np.mean(value_obj.data, axis=(0, 1))
+            mean_data = Average.mean_trace(value_obj)
             # make a trace value object
             print("Average:    Averaged a FluoFrames to a trace")
             # take Ch from DataType
@@ -598,6 +1254,29 @@ class Average(ModifierHandler):
                 value_obj.interval,
             )
 
+    # ROI frames are averaged by 4 lookups per frame in the integral image of the
+    # original frames. It is made at the first ROI and kept in the original frames.
+    @staticmethod
+    def mean_trace(frames_obj) -> np.ndarray:
+        base, offset = frames_obj.get_origin()
+        if base is frames_obj:
+            return np.mean(frames_obj.data, axis=(0, 1))
+        return Average.sliced_mean_trace(base, offset, frames_obj.data)
+
+    # data = base.data[x:, y:, t:] in the size of data. offset = (x, y, t)
+    @staticmethod
+    def sliced_mean_trace(base, offset, data) -> np.ndarray:
+        integral_image = base.integral_image
+        if integral_image is None:
+            return np.mean(data, axis=(0, 1))
+        x, y, t = offset
+        x_width, y_width, num_t = data.shape
+        mean_data = integral_image.roi_mean(x, y, x_width, y_width, t, t + num_t)
+        # the same dtype as np.mean
+        if np.issubdtype(data.dtype, np.floating):
+            mean_data = mean_data.astype(data.dtype)
+        return mean_data
+
 
 class Scale(ModifierHandler):
     def __init__(self, modifier_name):
@@ -620,15 +1299,22 @@ class Scale(ModifierHandler):
             return data_obj
 
         elif self.scale_mode == "DFoF":
-            f = Tools.f_value(data_obj.data)
+            if isinstance(data_obj, TracesData):  # F of each trace
+                f = np.array([Tools.f_value(trace) for trace in data_obj.data])
+                f = f[:, np.newaxis]
+            else:
+                f = Tools.f_value(data_obj.data)
             df_over_f = (data_obj / f - 1) * 100
             print("Scale:      Original -> dF/F")
             return df_over_f
 
         elif self.scale_mode == "Normalize":
-            min_val = np.min(data_obj.data)
+            # min and max of each trace for TracesData
+            axis = 1 if isinstance(data_obj, TracesData) else None
+            keepdims = axis is not None
+            min_val = np.min(data_obj.data, axis=axis, keepdims=keepdims)
             pre_data_obj = data_obj - min_val
-            max_val = np.max(pre_data_obj.data)
+            max_val = np.max(pre_data_obj.data, axis=axis, keepdims=keepdims)
             normalized_data = pre_data_obj / max_val
             print("Scale:      Original -> Normalized")
             return normalized_data
@@ -642,9 +1328,11 @@ class Scale(ModifierHandler):
 class BlComp(ModifierHandler):
     def __init__(self, modifier_name):
         super().__init__(modifier_name)
-        self.bl_mode = "Disable"  # or 'PolyVal' or 'Exponential'
+        self.bl_mode = "Disable"  # or 'PolyVal', 'Exponential' or 'FastExponential'
         self.baseline_window = None  # This is to show the baseline and fitting curve
         self.cutting_time_window = [0, 0]  # [start, width]
+        self.__fit_service = FitService()  # fitted parameters cache
+        self.__shown_params = None  # parameters in the baseline window
 
     def __del__(self):  # make a message when this object is deleted.
         print(".")
@@ -663,53 +1351,34 @@ class BlComp(ModifierHandler):
         else:
             raise ValueError(f"value: '{val}' should be a string or a list")
 
+    # The baseline comes from the observer and a fitting window is shown.
+    @property
+    def cacheable(self) -> bool:
+        return self.bl_mode == "Disable"
+
+    @property
+    def thread_safe(self) -> bool:
+        return self.bl_mode == "Disable"
+
     def set_data(self, data_obj) -> object:
         if self.bl_mode == "Disable":
             print("BlComp:     No modified")
             return data_obj
-        # make Polyval fitting curve
-        elif self.bl_mode == "PolyVal":
-            print("BlComp:     Enable -> <PolyVal> baseline compensation")
-            degree_poly = 2
-            data_type = data_obj.data_tag["DataType"].replace("Trace", "Frames")
-            bl_trace_raw = self.observer.notify_observer_second_obj(data_type)
-            bl_trace = bl_trace_raw.slice_data(
-                self.cutting_time_window[0], self.cutting_time_window[1]
-            )
-
-            mu = [np.mean(bl_trace.time), np.std(bl_trace.time)]
-            # time data centering and scaling
-            t_scaled = (bl_trace.time - mu[0]) / mu[1]
-            # Polynomial fitting with scaled data
-            fitcoef = np.polyfit(t_scaled, bl_trace.data, degree_poly)
-            # Evaluate fitted polynomial in data points
-            # fitting_trace = np.polyval(fitcoef, t_scaled)
-            # Scaling x values
-            x_scaled = (data_obj.time - mu[0]) / mu[1]
-            # Evaluate polynomial
-            fitting_trace_raw = np.polyval(fitcoef, x_scaled)
-        # make exponential fitting curve: currently doen't work well
-        elif self.bl_mode == "Exponential":
-            print("BlComp:     Enable -> <Exponential> baseline compensation")
+        # PolyVal, Exponential (curve_fit) or FastExponential (non-iterative)
+        elif self.bl_mode in FitService.fitter_dict:
+            print(f"BlComp:     Enable -> <{self.bl_mode}> baseline compensation")
             data_type = data_obj.data_tag["DataType"].replace("Trace", "Frames")
             bl_trace_raw = self.observer.notify_observer_second_obj(data_type)
-
             bl_trace = bl_trace_raw.slice_data(
                 self.cutting_time_window[0], self.cutting_time_window[1]
             )
-
-            initial_guess = (np.max(bl_trace.data), -0.1, np.min(bl_trace.data))
-            popt, pcov = curve_fit(
-                Tools.exponential_func,
+            # the same baseline trace uses the cached parameters
+            fitting_trace_raw, params = self.__fit_service.fit(
+                self.bl_mode,
                 bl_trace.time,
                 bl_trace.data,
-                p0=initial_guess,
-                maxfev=2000,
-            )
-
-            a_fit, b_fit, c_fit = popt
-            fitting_trace_raw = Tools.exponential_func(
-                data_obj.time, a_fit, b_fit, c_fit
+                data_obj.time,
+                self.cutting_time_window,
             )
         else:
             raise ValueError(
@@ -736,10 +1405,13 @@ class BlComp(ModifierHandler):
             self.baseline_window = pg.plot()
             self.baseline_window.setWindowTitle("Baseline fitting")
             self.baseline_window.setGeometry(100, 100, 200, 150)
+        elif params is self.__shown_params:  # the same fitting is already shown
+            return bl_comp_trace
         else:
             self.baseline_window.clear()
         bl_trace.show_data(self.baseline_window)
         fit_baseline_obj.show_data(self.baseline_window)
+        self.__shown_params = params
 
         return bl_comp_trace
 
@@ -754,6 +1426,15 @@ class DifImage(ModifierHandler):
         self._val_obj = TimeWindowVal(start, width)  # replace the roi
         print(f"set DifImage: {self._val_obj.data} ")
 
+    # The baseline image comes from the observer.
+    @property
+    def cacheable(self) -> bool:
+        return False
+
+    @property
+    def thread_safe(self) -> bool:
+        return False
+
     def set_data(self, data_obj) -> object:
         print("DifImage:     Enable")
         data_type = data_obj.data_tag["DataType"].replace("Image", "Frames")
@@ -813,8 +1494,11 @@ class EndModifier(ModifierHandler):
 
 
 class Observer:
-    def __init__(self):
+    # modifier_name is sent with the notification, so the axes controllers can
+    # update only items made with the modifier.
+    def __init__(self, modifier_name=None):
         self._observers = []
+        self._modifier_name = modifier_name
 
     def set_observer(self, observer):
         for check_observer in self._observers:
@@ -830,7 +1514,7 @@ class Observer:
     def notify_observer(self):
         for observer_name in self._observers:
             # enable view axes update
-            observer_name.set_update_flag(True)
+            observer_name.set_update_flag(True, self._modifier_name)
             # This is for direct view axes update
             # observer_name.update()
         # print("Update Notification from ROI")
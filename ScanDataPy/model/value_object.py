@@ -5,10 +5,12 @@ Created on Sun Jan  1 10:04:06 2023
 @author: lunelukkio@gmail.com
 """
 import sys
+import threading
 from abc import ABCMeta, abstractmethod
 import numpy as np
 import pyqtgraph as pg
 import inspect
+from ScanDataPy.model.analyze.integral_image import IntegralImage
 
         
 """
@@ -16,8 +18,13 @@ Value object
 """
 class ValueObj(metaclass=ABCMeta): 
     def __init__(self, val, data_tag):
-        self._data = val
+        # ndarray is kept as a read-only view. It is not copied, so slices of slices
+        # share one buffer. Use copy_data() to get a writable copy.
         if isinstance(val, np.ndarray):
+            val = val.view()
+            val.flags.writeable = False
+        self._data = val
+        if isinstance(val, np.ndarray) or hasattr(val, 'shape'):  # include lazy frames
             self._shape = val.shape  # data dimension e.g. frames [pixel, pixel, frame]
         else:
             self._shape = None
@@ -40,6 +47,49 @@ class ValueObj(metaclass=ABCMeta):
     def shape(self) -> int:
         return self._shape
 
+    # ndarrays of a pickle (e.g. from a process pool) are writable. Keep them read-only.
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self._data, np.ndarray):
+            self._data.flags.writeable = False
+
+    # writable copy of the data for modifying (copy on write)
+    def copy_data(self) -> np.ndarray:
+        return np.array(self._data)
+
+    # size of the data (view)
+    @property
+    def nbytes(self) -> int:
+        if isinstance(self._data, np.ndarray):
+            return self._data.nbytes
+        return 0
+
+    # the ndarray which has the memory of the data. The data can be a view of it.
+    # None if the data is not an ndarray. (e.g. LazyFrames, text)
+    @property
+    def owner(self):
+        owner = self._data
+        if not isinstance(owner, np.ndarray):
+            return None
+        while isinstance(owner.base, np.ndarray):
+            owner = owner.base
+        return owner
+
+    # memory kept by the data. A memmap uses no memory until it is read.
+    @property
+    def owner_nbytes(self) -> int:
+        owner = self.owner
+        if owner is None or isinstance(owner, np.memmap):
+            return 0
+        return owner.nbytes
+
+    # The same owner id means the same buffer.
+    def print_memory_infor(self):
+        owner = self.owner
+        print(f"{self.__class__.__name__}: {self._data_tag}")
+        print(f"    nbytes = {self.nbytes}, owner nbytes = {self.owner_nbytes}, "
+              f"memmap = {isinstance(owner, np.memmap)}, owner id = {id(owner)}")
+
     @property
     def data_tag(self) -> list:
         return self._data_tag
@@ -53,20 +103,42 @@ class ValueObj(metaclass=ABCMeta):
         raise NotImplementedError()
 
 class FramesData(ValueObj):
+    # base and offset are for frames sliced from other frames by TimeWindow and Roi.
+    # val = base.data[x:, y:, t:] with offset = (x, y, t) in the size of val.
+    # is_source is True for frames of a file made by the builders. They are kept in
+    # the repository, so only they keep an integral image.
     def __init__(self, 
                  val: np.ndarray, 
                  data_tag=None,
                  interval=0,
-                 pixel_size=None):
+                 pixel_size=None,
+                 base=None,
+                 offset=(0, 0, 0),
+                 is_source=False):
         super().__init__(val, data_tag)
         assert val.ndim == 3, 'The argument of FrameData should be numpy 3D data(x, y, t)'
             
         self.__interval = interval  # frame interval (ms)
         self.__pixel_size = pixel_size  #actual length (um)
+        self.__base = base  # original FramesData or None
+        self.__offset = tuple(offset)
+        self.__is_source = is_source
+        self.__integral_image = None  # made at the first use
+        self.__integral_image_lock = threading.Lock()
    
     # This is for background subtraction
     def __sub__(self):
         raise NotImplementedError()
+
+    # FramesData is pickled by process pools. A lock can't be pickled.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_FramesData__integral_image_lock"]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.__integral_image_lock = threading.Lock()
             
     @property
     def interval(self):
@@ -76,6 +148,48 @@ class FramesData(ValueObj):
     def pixel_size(self):
         return self.__pixel_size
 
+    @property
+    def base(self):
+        return self.__base
+
+    @property
+    def offset(self) -> tuple:
+        return self.__offset
+
+    @property
+    def is_source(self) -> bool:
+        return self.__is_source
+
+    # the original frames and the offset in it. for slicing again without copies.
+    def get_origin(self):
+        if self.__base is None:
+            return self, (0, 0, 0)
+        return self.__base, self.__offset
+
+    # summed-area table of the frames for ROI traces. It is made once and kept
+    # in this object. None if it is too large for the memory. see IntegralImage
+    # It is made only once when ROI traces are made in threads.
+    # Only source frames have it. Frames made by modifiers (e.g. TemporalBin) are
+    # not kept, so the table would be made again at every request.
+    # Memory mapped frames (np.memmap, LazyFrames) don't have it. It reads the
+    # whole file, so ROI traces are read from the slices of the file instead.
+    @property
+    def integral_image(self):
+        if not self.__is_source or type(self._data) is not np.ndarray:
+            return None
+        if self.__integral_image is None:
+            with self.__integral_image_lock:
+                if self.__integral_image is None:
+                    integral_image = IntegralImage.from_frames_in_memory(self._data)
+                    # False: don't try again
+                    self.__integral_image = integral_image or False
+        return self.__integral_image or None
+
+    # True if the integral image was already made.
+    @property
+    def has_integral_image(self) -> bool:
+        return bool(self.__integral_image)
+
     # plt should be an axes in a view class object = AxesImage
     def show_data(self, frame_num, plt=pg) -> object:
         return plt.setImage(self._data[:, :, frame_num])
@@ -106,7 +220,7 @@ class ImageData(ValueObj):
             assert self._data.shape == val_obj.data.shape, "!!! Caution! The size of these data is not matched!"
             image = func(self._data, val_obj.data)
         # if val_obj is numerics
-        elif type(val_obj) in [float, int, np.int64, np.float64]:
+        elif isinstance(val_obj, (int, float, np.number)):
             image = func(self._data, val_obj)
         else:
             raise TypeError(f"val_obj must be a numeric type or TraceData, but got {type(val_obj).__name__}")
@@ -136,15 +250,15 @@ class TraceData(ValueObj):
             print('Warning!!! The number of the data points of TraceData is less than 5 !!!')
             print('It makes a bug during dF over calculation !!!')
             print('------------------------------------------------------------------------')
-        if time is None:
-            self.__time = self.__create_time_data(val, interval)
-        else:
-            self.__time = time
+        # If time is None, it is made when it is used first.
+        self.__time = time
         self.__length = val.shape[0]  # the number of data points
         self.__interval = interval  # data interval
 
     @property
     def time(self) -> np.ndarray:
+        if self.__time is None:
+            self.__time = self.__create_time_data(self._data, self.__interval)
         return self.__time
 
     @time.setter
@@ -167,7 +281,7 @@ class TraceData(ValueObj):
             assert len(self._data) == len(val_obj.data), "!!! Caution! The length of these data is not matched!"
             trace = func(self._data, val_obj.data)
         # if val_obj is numerics
-        elif type(val_obj) in [float, int, np.int64, np.float64]:
+        elif isinstance(val_obj, (int, float, np.number)):
             trace = func(self._data, val_obj)
         else:
             raise TypeError(f"val_obj must be a numeric type or TraceData, but got {type(val_obj).__name__}")
@@ -198,8 +312,8 @@ class TraceData(ValueObj):
     def slice_data(self, start, width):
         first_half_data = self._data[:start + 1]
         second_half_data = self._data[start + width:]
-        first_half_time = self.__time[:start + 1]
-        second_half_time = self.__time[start + width:]
+        first_half_time = self.time[:start + 1]
+        second_half_time = self.time[start + width:]
 
         new_data = np.concatenate((first_half_data, second_half_data))
         new_time = np.concatenate((first_half_time, second_half_time))
@@ -207,8 +321,74 @@ class TraceData(ValueObj):
         return TraceData(new_data, self._data_tag, self.__interval, new_time)
     
     def show_data(self, plt=pg) -> list:  # plt should be an axes in a view class object = [matplotlib.lines.Line2D]
-            return plt.plot(self.__time, self._data) 
+            return plt.plot(self.time, np.asarray(self._data)) 
+
+
+
+class TracesData(ValueObj):
+    # many traces with the same time. [trace, t] e.g. a trace of each roi of MultiRoi
+    def __init__(
+            self,
+            val: np.ndarray,
+            data_tag=None,
+            interval=0,
+    ):
+        super().__init__(val, data_tag)
+        assert val.ndim == 2, 'The argument of TracesData should be numpy 2D data(trace, t)'
+        self.__time = None  # made when it is used first.
+        self.__interval = interval  # data interval
 
+    @property
+    def time(self) -> np.ndarray:
+        if self.__time is None:
+            num_data_point = self._shape[1]
+            self.__time = np.linspace(0, self.__interval * (num_data_point - 1), num_data_point)
+        return self.__time
+
+    @property
+    def num_traces(self) -> int:
+        return self._shape[0]
+
+    @property
+    def length(self) -> int:
+        return self._shape[1]
+
+    @property
+    def interval(self) -> float:
+        return self.__interval
+
+    # a single trace as TraceData
+    def get_trace(self, num) -> TraceData:
+        return TraceData(self._data[num], self._data_tag, self.__interval, self.time)
+
+    # val_obj is TracesData, numerics or an array for each trace [trace, 1]
+    def operator(self, val_obj, func):
+        if type(val_obj) == TracesData:
+            assert self._data_tag['DataType'] == val_obj.data_tag['DataType'], \
+            f"TracesData class: data_tag['DataType'] is not the same DataType. {self._data_tag['DataType']} - {val_obj.data_tag['DataType']}"
+            assert self._shape == val_obj.shape, "!!! Caution! The size of these data is not matched!"
+            traces = func(self._data, val_obj.data)
+        elif isinstance(val_obj, (int, float, np.number, np.ndarray)):
+            traces = func(self._data, val_obj)
+        else:
+            raise TypeError(f"val_obj must be a numeric type, ndarray or TracesData, but got {type(val_obj).__name__}")
+
+        return TracesData(traces, self._data_tag, self.__interval)
+
+    def __add__(self, val_obj) -> object:
+        return self.operator(val_obj, np.add)
+
+    def __sub__(self, val_obj) -> object:
+        return self.operator(val_obj, np.subtract)
+
+    def __truediv__(self, val_obj) -> object:
+        return self.operator(val_obj, np.true_divide)
+
+    def __mul__(self, val_obj) -> object:
+        return self.operator(val_obj, np.multiply)
+
+    def show_data(self, plt=pg) -> list:  # a list of plot items
+        return [plt.plot(self.time, np.asarray(trace)) for trace in self._data]
 
 
 class TextData(ValueObj):
@@ -274,6 +454,39 @@ class RoiVal:  # Should be called by the same class for __add__ and __sub__
         self.__data_type = data_type
     
     
+class MultiRoiVal:
+    # many rois. rois = [[x, y, x_width, y_width], ...] or a label mask.
+    # label_mask = 2D int array (x, y). 0 is background and 1, 2, 3... are rois.
+    def __init__(self, rois=None, label_mask=None):
+        if (rois is None) == (label_mask is None):
+            raise ValueError('MultiRoiVal needs either rois or label_mask.')
+        if rois is not None:
+            self.__mode = 'Rect'
+            self.__data = np.array(rois, dtype=np.int64).reshape(-1, 4)
+            if np.any(self.__data[:, 2:] < 1):
+                print('ROI width values should be 1 or more')
+        else:
+            self.__mode = 'Label'
+            self.__data = np.array(label_mask)
+            if self.__data.ndim != 2 or not np.issubdtype(self.__data.dtype, np.integer):
+                raise ValueError('The label mask should be a 2D int array (x, y).')
+        self.__data.flags.writeable = False
+
+    @property
+    def data(self) -> np.ndarray:
+        return self.__data
+
+    @property
+    def mode(self) -> str:  # 'Rect' or 'Label'
+        return self.__mode
+
+    @property
+    def num_rois(self) -> int:
+        if self.__mode == 'Rect':
+            return self.__data.shape[0]
+        return int(self.__data.max(initial=0))
+
+
 # self.__data = frame number.  width = -1 means start from the end of the trace
 class TimeWindowVal:
     # be careful about end_width. np.mean slice a value not include end.
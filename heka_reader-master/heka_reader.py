@@ -20,7 +20,7 @@ Brief example::
 """
 
 import numpy as np
-import re, struct, collections
+import io, re, struct, collections
 
 
 class Struct(object):
@@ -143,6 +143,65 @@ class Struct(object):
     def size(cls):
         cls._field_info()
         return cls._le_struct.size
+
+    # struct format characters -> numpy types ('<' standard sizes)
+    _np_types = {'c': 'V1', 'b': 'i1', 'B': 'u1', '?': '?', 'h': 'i2', 'H': 'u2',
+                 'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8',
+                 'f': 'f4', 'd': 'f8'}
+
+    @classmethod
+    def dtype(cls, endian='<'):
+        """Return a packed numpy structured dtype with the same layout as the
+        struct. Field *i* is named 'f<i>'; strings and sub-structures are raw
+        bytes ('V<n>') that are converted when the field is decoded.
+        """
+        names = []
+        formats = []
+        for i, (name, fmt, func) in enumerate(cls._field_info()):
+            code = fmt[-1]
+            n = int(fmt[:-1]) if len(fmt) > 1 else 1
+            if code in 'sx':
+                np_fmt = 'V%d' % n
+            elif n == 1:
+                np_fmt = endian + cls._np_types[code]
+            else:
+                np_fmt = (endian + cls._np_types[code], (n,))
+            names.append('f%d' % i)
+            formats.append(np_fmt)
+        dtype = np.dtype({'names': names, 'formats': formats})
+        assert dtype.itemsize == cls.size()
+        return dtype
+
+    @classmethod
+    def _field_lookup(cls):
+        """Return {name: (dtype field name, format, function)} of decoded fields.
+        """
+        if '_lookup' not in cls.__dict__:
+            cls._lookup = {name: ('f%d' % i, fmt, func)
+                           for i, (name, fmt, func) in enumerate(cls._field_info())
+                           if func is not None}
+        return cls._lookup
+
+    @staticmethod
+    def _decode(value, fmt, func, endian):
+        """Convert a field of a numpy record to the value that Struct gives.
+        """
+        code = fmt[-1]
+        n = int(fmt[:-1]) if len(fmt) > 1 else 1
+        if code == 's':
+            item = value.tobytes()
+        elif code == 'c':
+            item = value.tobytes() if n == 1 else tuple(v.tobytes() for v in value)
+        elif n == 1:
+            item = value.item()
+        else:
+            item = tuple(value.tolist())
+        if isinstance(func, tuple):
+            substr, func = func
+            item = substr(item, endian)
+        if func is not True:
+            item = func(item)
+        return item
     
     @classmethod
     def array(cls, x):
@@ -274,6 +333,40 @@ class TreeNode(Struct):
         for i in range(nchild):
             self.children.append(child_rectype(fh, pul, level))
 
+    @classmethod
+    def from_record(cls, records, index, level, endian):
+        """Make a node of a record which is decoded in bulk. Fields are
+        converted at the first access. see Pulsed.parse_tree
+        """
+        node = cls.__new__(cls)
+        node.level = level
+        node.children = []
+        node._records = records
+        node._index = index
+        node._endian = endian
+        return node
+
+    def __getattr__(self, name):
+        # only for nodes made by from_record()
+        records = self.__dict__.get('_records')
+        if records is None:
+            raise AttributeError(name)
+        record = records[self._index]
+        if name == 'fields':
+            fields = collections.OrderedDict()
+            for field_name, (key, fmt, func) in self._field_lookup().items():
+                fields[field_name] = self._decode(record[key], fmt, func, self._endian)
+                setattr(self, field_name, fields[field_name])
+            self.fields = fields
+            return fields
+        lookup = self._field_lookup()
+        if name not in lookup:
+            raise AttributeError(name)
+        key, fmt, func = lookup[name]
+        item = self._decode(record[key], fmt, func, self._endian)
+        setattr(self, name, item)
+        return item
+
     def __getitem__(self, i):
         return self.children[i]
     
@@ -580,8 +673,8 @@ class Pulsed(TreeNode):
     ]
     
     def __init__(self, bundle, offset=0, size=None):
-        fh = open(bundle.file_name, 'rb')
-        fh.seek(offset)
+        # read the tree from the memory map of the bundle. No file is opened.
+        fh = bundle.section(offset, size)
         
         # read .pul header
         magic = fh.read(4) 
@@ -600,25 +693,120 @@ class Pulsed(TreeNode):
             size = struct.unpack(self.endian + 'i', fh.read(4))[0]
             self.level_sizes.append(size)
             
-        TreeNode.__init__(self, fh, self)
+        self.parse_tree(fh.getvalue(), fh.tell())
+
+    def parse_tree(self, buf, pos):
+        """Read the tree like TreeNode.__init__, but decode the records of every
+        level in bulk with numpy structured dtypes.
+        """
+        endian = self.endian
+        num_levels = len(self.rectypes)
+        nchild_struct = struct.Struct(endian + 'i')
+
+        # Walk the tree once to get the offset and the parent of every record.
+        # Records are stored depth first: record, number of children, children...
+        offsets = [[] for _ in range(num_levels)]
+        parents = [[] for _ in range(num_levels)]
+        stack = []  # [[level, parent index, remaining children], ...]
+        level, parent = 0, -1
+        while True:
+            offsets[level].append(pos)
+            parents[level].append(parent)
+            pos += self.level_sizes[level]
+            nchild = nchild_struct.unpack_from(buf, pos)[0]
+            pos += 4
+            if level + 1 < num_levels and nchild > 0:
+                stack.append([level + 1, len(offsets[level]) - 1, nchild])
+            while stack and stack[-1][2] == 0:
+                stack.pop()
+            if not stack:
+                break
+            stack[-1][2] -= 1
+            level, parent = stack[-1][0], stack[-1][1]
+
+        # The root is this object. Pad or truncate like TreeNode.__init__
+        self.level = 0
+        self.children = []
+        realsize = self.level_sizes[0]
+        data = buf[offsets[0][0]:offsets[0][0] + realsize]
+        data = data[:self.size()] + b'\0' * max(self.size() - realsize, 0)
+        Struct.__init__(self, data, endian)
+
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        nodes = [[self]]
+        for level in range(1, num_levels):
+            rectype = self.rectypes[level]
+            if len(offsets[level]) == 0:
+                nodes.append([])
+                continue
+            # copy min(realsize, structsize) bytes of every record; the rest is 0.
+            structsize = rectype.size()
+            nbytes = min(self.level_sizes[level], structsize)
+            record_bytes = np.zeros((len(offsets[level]), structsize), dtype=np.uint8)
+            record_bytes[:, :nbytes] = raw[np.asarray(offsets[level])[:, None]
+                                           + np.arange(nbytes)]
+            records = record_bytes.view(rectype.dtype(endian)).ravel()
+            level_nodes = [rectype.from_record(records, i, level, endian)
+                           for i in range(len(records))]
+            for node, parent in zip(level_nodes, parents[level]):
+                nodes[level - 1][parent].children.append(node)
+            nodes.append(level_nodes)
 
 
 class Data(object):
+    """Trace data in a bundle.
+
+    ``data[g, s, sw, t]`` returns a scaled float64 array of a trace, and
+    ``data.raw((g, s, sw, t))`` returns a zero-copy view of the stored samples.
+    """
+    dtypes = [np.int16, np.int32, np.float16, np.float32]
+
     def __init__(self, bundle, offset=0, size=None):
         self.bundle = bundle
         self.offset = offset
-        
-    def __getitem__(self, *args):
-        index = args[0]
+
+    def trace_record(self, index):
         assert len(index) == 4
         pul = self.bundle.pul
-        trace = pul[index[0]][index[1]][index[2]][index[3]]
-        fh = open(self.bundle.file_name, 'rb')
-        fh.seek(trace.Data)
+        return pul[index[0]][index[1]][index[2]][index[3]]
+
+    def raw(self, index):
+        """Return a read-only view of the unscaled samples of a trace.
+        """
+        trace = self.trace_record(index)
         fmt = bytearray(trace.DataFormat)[0]
-        dtype = [np.int16, np.int32, np.float16, np.float32][fmt]
-        data = np.fromfile(fh, count=trace.DataPoints, dtype=dtype)
-        return data * trace.DataScaler + trace.ZeroData
+        dtype = np.dtype(self.dtypes[fmt]).newbyteorder(self.bundle.endian)
+        return self.bundle.view(trace.Data, trace.DataPoints, dtype)
+
+    def __getitem__(self, *args):
+        index = args[0]
+        trace = self.trace_record(index)
+        return self.raw(index) * trace.DataScaler + trace.ZeroData
+
+    def series(self, group, series, trace):
+        """Return every sweep of one trace in a series as a float64 array
+        [sweep, data point].
+
+        Sweeps with the same length and format are read in one pass from the
+        memory map and scaled at once. Otherwise shorter sweeps are padded
+        with NaN.
+        """
+        records = [sweep[trace] for sweep in self.bundle.pul[group][series]]
+        if len(records) == 0:
+            return np.empty((0, 0))
+        offsets = np.array([rec.Data for rec in records], dtype=np.int64)
+        counts = np.array([rec.DataPoints for rec in records], dtype=np.int64)
+        formats = set(bytearray(rec.DataFormat)[0] for rec in records)
+        scalers = np.array([rec.DataScaler for rec in records])[:, None]
+        zeros = np.array([rec.ZeroData for rec in records])[:, None]
+        if len(formats) == 1 and counts.min() == counts.max():
+            dtype = np.dtype(self.dtypes[formats.pop()]).newbyteorder(self.bundle.endian)
+            raw = self.bundle.view_many(offsets, int(counts[0]), dtype)
+            return raw * scalers + zeros
+        data = np.full((len(records), counts.max()), np.nan)
+        for i, rec in enumerate(records):
+            data[i, :rec.DataPoints] = self.raw((group, series, i, trace))
+        return data * scalers + zeros
 
 
 class Bundle(object):
@@ -630,16 +818,20 @@ class Bundle(object):
     
     def __init__(self, file_name):
         self.file_name = file_name
-        fh = open(file_name, 'rb')
+        # A read-only memory map of the file is kept while the bundle is open.
+        # The tree and the trace data are read through it.
+        self._mmap = np.memmap(file_name, dtype=np.uint8, mode='r')
+        fh = self.section(0, BundleHeader.size())
         # Read header assuming little endiam
         endian = '<'
         self.header = BundleHeader(fh, endian)
 
         # If the header is bad, re-read using big endian
-        if self.header.IsLittleEndian[0] == b'\0':
+        if self.header.IsLittleEndian[0:1] == b'\0':
             endian = '>'
             fh.seek(0)
             self.header = BundleHeader(fh, endian)
+        self.endian = endian
             
         # Read bundle items
         #self.bundle_items = [Struct(fh, endian + bundle_item[0], bundle_item[1]) for i in range(12)]
@@ -652,6 +844,64 @@ class Bundle(object):
             self.catalog[ext] = item
         fh.close()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the memory map. Arrays returned before stay valid.
+        """
+        self._mmap = None
+
+    def _buffer(self):
+        if self._mmap is None:
+            raise ValueError('I/O operation on a closed bundle: %s' % self.file_name)
+        return self._mmap
+
+    def section(self, offset, size=None):
+        """Return a file-like object of the bytes in [offset, offset + size).
+        """
+        buf = self._buffer()
+        end = len(buf) if size is None else offset + size
+        return io.BytesIO(buf[offset:end].tobytes())
+
+    def view_many(self, offsets, count, dtype):
+        """Return [len(offsets), count] items of *dtype* at *offsets*.
+
+        Evenly spaced blocks (e.g. sweeps written one after another) are a
+        zero-copy strided view; other blocks are gathered in one copy.
+        """
+        dtype = np.dtype(dtype)
+        buf = self._buffer()
+        offsets = np.asarray(offsets, dtype=np.int64)
+        nbytes = count * dtype.itemsize
+        if len(offsets) > 0 and (
+                offsets.min() < 0 or offsets.max() + nbytes > len(buf)):
+            raise IndexError('Blocks of %d bytes at offsets %d-%d are out of %s '
+                             '(%d bytes)' % (nbytes, offsets.min(), offsets.max(),
+                                             self.file_name, len(buf)))
+        steps = np.diff(offsets)
+        if len(steps) > 0 and (steps == steps[0]).all() and steps[0] >= nbytes:
+            blocks = np.lib.stride_tricks.as_strided(
+                buf[offsets[0]:], shape=(len(offsets), nbytes),
+                strides=(int(steps[0]), 1), writeable=False)
+        else:
+            blocks = buf[offsets[:, None] + np.arange(nbytes)]
+        return blocks.view(dtype)
+
+    def view(self, offset, count, dtype):
+        """Return a read-only view of *count* items of *dtype* at *offset*.
+        """
+        dtype = np.dtype(dtype)
+        buf = self._buffer()
+        nbytes = count * dtype.itemsize
+        if offset < 0 or offset + nbytes > len(buf):
+            raise IndexError('%d bytes at offset %d are out of %s (%d bytes)'
+                             % (nbytes, offset, self.file_name, len(buf)))
+        return buf[offset:offset + nbytes].view(dtype)
+
     @property
     def pul(self):
         """The Pulsed object from this bundle.
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+IntegralImage ROI traces against direct means of the frames.
+
+lunelukkio@gmail.com
+"""
+
+import unittest
+import numpy as np
+from ScanDataPy.model.analyze.integral_image import IntegralImage
+from ScanDataPy.model.value_object import FramesData
+
+
+class TestIntegralImage(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frames = rng.normal(1000, 50, (20, 16, 30)).astype(np.float32)
+        self.sat = IntegralImage.from_frames(self.frames)
+
+    def test_roi_mean(self):
+        for x, y, x_width, y_width in [(0, 0, 1, 1), (3, 4, 5, 2), (10, 8, 10, 8)]:
+            direct = np.mean(
+                self.frames[x : x + x_width, y : y + y_width, 5:25],
+                axis=(0, 1), dtype=np.float64,
+            )
+            sat_mean = self.sat.roi_mean(x, y, x_width, y_width, 5, 25)
+            np.testing.assert_allclose(sat_mean, direct, rtol=1e-6)
+
+    def test_rois_mean(self):
+        rois = [[0, 0, 20, 16], [2, 3, 4, 5], [15, 10, 10, 10]]  # the last is clipped
+        sat_means = self.sat.rois_mean(rois)
+        self.assertEqual(sat_means.shape, (3, 30))
+        for (x, y, x_width, y_width), sat_mean in zip(rois, sat_means):
+            direct = np.mean(
+                self.frames[x : x + x_width, y : y + y_width], axis=(0, 1), dtype=np.float64
+            )
+            np.testing.assert_allclose(sat_mean, direct, rtol=1e-6)
+
+    def test_roi_out_of_frames(self):
+        self.assertTrue(np.isnan(self.sat.roi_mean(30, 0, 2, 2)).all())
+
+    def test_chunked_build(self):
+        chunk_bytes = IntegralImage.CHUNK_BYTES
+        IntegralImage.CHUNK_BYTES = 20 * 16 * 8 * 4  # 4 frames in a chunk
+        try:
+            chunked = IntegralImage.from_frames(self.frames)
+        finally:
+            IntegralImage.CHUNK_BYTES = chunk_bytes
+        np.testing.assert_array_equal(chunked.rois_sum([[1, 2, 3, 4]]),
+                                      self.sat.rois_sum([[1, 2, 3, 4]]))
+
+    def test_no_table_for_memmap(self):
+        frames_obj = FramesData(self.frames, is_source=True)
+        self.assertIsNotNone(frames_obj.integral_image)
+        mapped = self.frames.view(np.memmap)
+        self.assertIsNone(FramesData(mapped, is_source=True).integral_image)
+
+    def test_no_table_for_modified_frames(self):
+        self.assertIsNone(FramesData(self.frames).integral_image)
+
+
+if __name__ == '__main__':
+    unittest.main()
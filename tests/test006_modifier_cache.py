@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+ExecutionPlan and ResultCache of ModifierService against the sample .tsm file.
+
+lunelukkio@gmail.com
+"""
+
+import os
+import unittest
+import contextlib
+import io
+import numpy as np
+from ScanDataPy.model.model import DataService
+from ScanDataPy.model.modifier import ExecutionPlan
+from ScanDataPy.model.modifier import ResultCache
+from ScanDataPy.model.modifier import RoiTraceStep
+from ScanDataPy.model.value_object import FramesData
+
+
+# the settings are read from paths relative to the current directory
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+frames_tag = {
+    "Filename": "20408B002.tsm",
+    "Attribute": "Data",
+    "DataType": "FluoFramesCh1",
+    "Origin": "File",
+}
+
+
+class TestModifierCache(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(root_dir)
+        self.data_service = DataService()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.data_service.reset()
+            self.data_service.create_experiments("220408/20408B002.tsm")
+            for modifier_name in ["TimeWindow0", "Roi0", "Average0"]:
+                self.data_service.add_modifier(modifier_name)
+            self.data_service.set_modifier_val("TimeWindow0", [5, 30])
+            self.data_service.set_modifier_val("Roi0", [40, 40, 3, 3])
+            self.data_service.set_modifier_val("Average0", "Roi")
+        self.frames_obj = self.data_service._repository.find_by_keys(frames_tag)[0]
+        self.modifier_dict = {
+            modifier_obj.modifier_name: modifier_obj
+            for modifier_obj in self.data_service._modifier_service.modifier_chain_list
+        }
+
+    def tearDown(self):
+        self.data_service.shutdown()
+        os.chdir(self.cwd)
+
+    def test_fused_roi_trace(self):
+        for modifier_list, window in (
+            (["TimeWindow0", "Roi0", "Average0"], slice(5, 35)),
+            (["Roi0", "Average0"], slice(None)),
+        ):
+            plan = ExecutionPlan.compile(
+                self.data_service._modifier_service.modifier_chain_list, modifier_list
+            )
+            self.assertEqual(len(plan.step_list), 1)
+            self.assertIsInstance(plan.step_list[0], RoiTraceStep)
+            with contextlib.redirect_stdout(io.StringIO()):
+                fused = plan.run(self.frames_obj)
+                # the same modifiers one by one
+                unfused = self.frames_obj
+                for modifier_name in modifier_list:
+                    unfused = self.modifier_dict[modifier_name].set_data(unfused)
+            self.assertEqual(fused.data_tag, unfused.data_tag)
+            self.assertEqual(fused.interval, unfused.interval)
+            np.testing.assert_allclose(fused.data, unfused.data, rtol=1e-6)
+            direct = np.mean(self.frames_obj.data[40:43, 40:43, window], axis=(0, 1))
+            np.testing.assert_allclose(fused.data, direct, rtol=1e-5)
+
+    def test_cache_after_roi_change(self):
+        modifier_list = ["TimeWindow0", "Roi0", "Average0"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            trace_1 = self.data_service.get_data(frames_tag, modifier_list)
+            trace_2 = self.data_service.get_data(frames_tag, modifier_list)
+            self.data_service.set_modifier_val("Roi0", [10, 10, 3, 3])
+            trace_3 = self.data_service.get_data(frames_tag, modifier_list)
+        self.assertIs(trace_1, trace_2)
+        self.assertIsNot(trace_3, trace_1)
+        direct = np.mean(self.frames_obj.data[10:13, 10:13, 5:35], axis=(0, 1))
+        np.testing.assert_allclose(trace_3.data, direct, rtol=1e-5)
+        self.assertFalse(np.allclose(trace_3.data, trace_1.data))
+
+    def test_cache_bytes_of_views(self):
+        frames = np.zeros((10, 10, 100), dtype=np.float32)
+        owner_nbytes = frames.nbytes
+        cache = ResultCache(max_bytes=owner_nbytes * 2)
+        # views of the same buffer are counted once
+        for i in range(3):
+            cache.put(i, self.frames_obj, FramesData(frames[:, :, i * 10 :]))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, owner_nbytes)
+        # the third buffer is over max_bytes, so the least recently used are removed
+        for i in range(3, 5):
+            cache.put(i, self.frames_obj, FramesData(frames.copy()))
+        self.assertEqual(cache.nbytes, owner_nbytes * 2)
+        self.assertEqual(list(cache._cache), [3, 4])
+        cache.clear()
+        self.assertEqual(cache.nbytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
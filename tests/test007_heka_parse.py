@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+The .pul tree decoded in bulk (Pulsed.parse_tree) against the record by record
+parser (TreeNode.__init__) on the sample HEKA bundles.
+
+lunelukkio@gmail.com
+"""
+
+import os
+import sys
+import struct
+import unittest
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root_dir, "heka_reader-master"))
+from heka_reader import Bundle, Pulsed, TreeNode
+
+
+# read the .pul tree with TreeNode.__init__ as before the bulk decoding
+def parse_per_record(bundle):
+    item = bundle.catalog[".pul"]
+    fh = bundle.section(item.Start, item.Length)
+    pul = Pulsed.__new__(Pulsed)
+    magic = fh.read(4)
+    pul.endian = "<" if magic == b"eerT" else ">"
+    levels = struct.unpack(pul.endian + "i", fh.read(4))[0]
+    pul.level_sizes = [
+        struct.unpack(pul.endian + "i", fh.read(4))[0] for _ in range(levels)
+    ]
+    TreeNode.__init__(pul, fh, pul)
+    return pul
+
+
+class TestHekaParse(unittest.TestCase):
+    def assert_same_tree(self, node, expected, path=()):
+        self.assertEqual(node.get_fields(), expected.get_fields(), path)
+        self.assertEqual(repr(node), repr(expected), path)
+        self.assertEqual(len(node.children), len(expected.children), path)
+        for i, (child, expected_child) in enumerate(zip(node, expected)):
+            self.assert_same_tree(child, expected_child, path + (i,))
+
+    def test_bulk_parse(self):
+        for filename in ["DemoV9Bundle.dat", "Evoked_APs.dat"]:
+            with self.subTest(filename=filename):
+                with Bundle(os.path.join(root_dir, "220408", filename)) as bundle:
+                    self.assert_same_tree(bundle.pul, parse_per_record(bundle))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+MultiRoi traces against direct means of the frames.
+
+lunelukkio@gmail.com
+"""
+
+import unittest
+import numpy as np
+from ScanDataPy.model.modifier import MultiRoi
+from ScanDataPy.model.value_object import FramesData
+
+
+class TestMultiRoi(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frames = rng.normal(1000, 50, (20, 16, 30)).astype(np.float32)
+        # overlapping, clipped and out of the frames
+        self.rois = np.array(
+            [[0, 0, 1, 1], [3, 4, 5, 2], [4, 4, 6, 6], [-2, 5, 5, 5], [30, 0, 2, 2]]
+        )
+
+    def direct_means(self):
+        return [
+            np.mean(self.frames[max(x, 0) : x + x_width, y : y + y_width], axis=(0, 1))
+            for x, y, x_width, y_width in self.rois[:4]
+        ]
+
+    def test_rect_traces(self):
+        # sparse matrix for modified frames and integral image for source frames
+        for is_source in (False, True):
+            frames_obj = FramesData(self.frames, is_source=is_source)
+            mean_data = MultiRoi.rect_traces(frames_obj, self.rois)
+            self.assertEqual(frames_obj.has_integral_image, is_source)
+            self.assertEqual(mean_data.shape, (5, 30))
+            np.testing.assert_allclose(mean_data[:4], self.direct_means(), rtol=1e-5)
+            self.assertTrue(np.isnan(mean_data[4]).all())
+
+    def test_label_traces(self):
+        label_mask = np.zeros((20, 16), dtype=int)
+        label_mask[2:5, 3:9] = 1
+        label_mask[10, 10] = 3
+        mean_data = MultiRoi.label_traces(FramesData(self.frames), label_mask)
+        for label in (1, 3):
+            np.testing.assert_allclose(
+                mean_data[label - 1],
+                self.frames[label_mask == label].mean(axis=0),
+                rtol=1e-5,
+            )
+        self.assertTrue(np.isnan(mean_data[1]).all())
+
+
+if __name__ == "__main__":
+    unittest.main()